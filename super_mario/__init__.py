@@ -1,20 +1,43 @@
-from gym.envs.registration import register
-from .nes_env import NesEnv, MetaNesEnv
-from .super_mario_bros import SuperMarioBrosEnv, MetaSuperMarioBrosEnv
+from importlib import import_module
+
+from .levels import SMB_LEVELS
+
+# Env classes are imported on first access (e.g. by gym.make), so that importing the package
+# (or the level table, the reward engine, etc.) does not import the env modules or require fceux
+_LAZY_ATTRIBUTES = {
+    'NesEnv': '.nes_env',
+    'MetaNesEnv': '.nes_env',
+    'SuperMarioBrosEnv': '.super_mario_bros',
+    'MetaSuperMarioBrosEnv': '.super_mario_bros',
+}
+__all__ = ['SMB_LEVELS', 'register_envs'] + list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
 
 # Env registration
 # ==========================
-# (world_number, level_number, area_number, max_distance)
-SMB_LEVELS = [
-    (1, 1, 1, 3266), (1, 2, 3, 3266), (1, 3, 4, 2514), (1, 4, 5, 2430),
-    (2, 1, 1, 3298), (2, 2, 3, 3266), (2, 3, 4, 3682), (2, 4, 5, 2430),
-    (3, 1, 1, 3298), (3, 2, 2, 3442), (3, 3, 3, 2498), (3, 4, 4, 2430),
-    (4, 1, 1, 3698), (4, 2, 3, 3266), (4, 3, 4, 2434), (4, 4, 5, 2942),
-    (5, 1, 1, 3282), (5, 2, 2, 3298), (5, 3, 3, 2514), (5, 4, 4, 2429),
-    (6, 1, 1, 3106), (6, 2, 2, 3554), (6, 3, 3, 2754), (6, 4, 4, 2429),
-    (7, 1, 1, 2962), (7, 2, 3, 3266), (7, 3, 4, 3682), (7, 4, 5, 3453),
-    (8, 1, 1, 6114), (8, 2, 2, 3554), (8, 3, 3, 3554), (8, 4, 4, 4989)]
-try:
+_is_registered = False
+
+
+def register_envs():
+    # Registers the envs with gym (only stores the entry points, fceux is checked when an env is constructed)
+    global _is_registered
+    if _is_registered:
+        return
+    from gym.envs.registration import register
+    _is_registered = True
+
     for draw_tiles in range(2):
         tile_suffix = '-Tiles' if draw_tiles == 1 else ''
 
@@ -38,5 +61,21 @@ try:
                 # Seems to be non-deterministic about 5% of the time
                 nondeterministic=True,
             )
+
+    # Entity observations (single levels only)
+    for (world_number, level_number, area_number, max_distance) in SMB_LEVELS:
+        level = (world_number - 1) * 4 + (level_number - 1)
+        register(
+            id='SuperMarioBros-{}-{}-Entities-v2'.format(world_number, level_number),
+            entry_point='super_mario:SuperMarioBrosEnv',
+            max_episode_steps=10000,
+            reward_threshold=(max_distance - 40),
+            kwargs={ 'level': level, 'obs_mode': 'entities' },
+            nondeterministic=True,
+        )
+
+
+try:
+    register_envs()
 except Exception as e:
     print("%s" % e)
@@ -0,0 +1,181 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from importlib import import_module
+
+import numpy as np
+
+import gym
+
+from .levels import SMB_LEVELS, NUM_LEVELS, WORLD_NUMBER, LEVEL_NUMBER, PASSING_SCORE, get_standard_reward
+
+# Evaluates a policy on all levels, by running (level, seed) episodes in a pool of worker processes
+# The policy is given as 'module:function', where function(env) returns a callable policy(observation) -> action
+# The factory is called once per episode (with a new env), so it should cache expensive models at the module level
+#
+#   python -m super_mario.evaluate --policy my_agent:make_policy --episodes 5 --processes 8
+
+PERCENTILES = [10, 50, 90]
+
+_worker = {}    # Worker process state (set by _init_worker)
+
+
+def get_env_id(level, draw_tiles=False):
+    return 'SuperMarioBros-{}-{}{}-v2'.format(
+        SMB_LEVELS[level][WORLD_NUMBER], SMB_LEVELS[level][LEVEL_NUMBER], '-Tiles' if draw_tiles else '')
+
+
+def random_policy(env):
+    # Default policy - Samples a random action at every step
+    return lambda observation: env.action_space.sample()
+
+
+def load_policy_factory(policy):
+    # Returns the policy factory for 'random' or 'module:function'
+    if 'random' == policy:
+        return random_policy
+    module_name, _, function_name = policy.partition(':')
+    if not function_name:
+        raise gym.error.Error('Error - The policy "{}" is not valid. Expected "random" or "module:function"'.format(policy))
+    return getattr(import_module(module_name), function_name)
+
+
+def _init_worker(policy, draw_tiles, configure, max_steps):
+    _worker['policy_factory'] = load_policy_factory(policy)
+    _worker['draw_tiles'] = draw_tiles
+    _worker['configure'] = configure or {}
+    _worker['max_steps'] = max_steps
+
+
+def run_episode(job):
+    # Runs one episode in a worker - Returns a dict with the level, seed, distance, score, steps and wall-clock time
+    level, seed = job
+    start_time = time.time()
+    env = gym.make(get_env_id(level, _worker['draw_tiles']))
+    try:
+        env.unwrapped.configure(**_worker['configure'])
+        env.unwrapped.seed(seed)
+        policy = _worker['policy_factory'](env)
+        observation = env.reset()
+        distance = 0
+        steps = 0
+        is_finished = False
+        info = {}
+        while not is_finished and steps < _worker['max_steps']:
+            observation, reward, is_finished, info = env.step(policy(observation))
+            distance = max(distance, info.get('distance', 0))
+            steps += 1
+    finally:
+        env.close()
+    return {
+        'level': level,
+        'seed': seed,
+        'distance': distance,
+        'score': get_standard_reward(level, distance),
+        'steps': steps,
+        'ignore': 'ignore' in info,
+        'time': time.time() - start_time,
+    }
+
+
+def summarize(results):
+    # Aggregates episode results per level - Stuck episodes (ignore=True) are excluded from the scores
+    report = {}
+    for level in sorted(set(result['level'] for result in results)):
+        level_results = [result for result in results if result['level'] == level]
+        valid_results = [result for result in level_results if not result['ignore']] or level_results
+        scores = np.array([result['score'] for result in valid_results], dtype=np.float64)
+        distances = np.array([result['distance'] for result in valid_results], dtype=np.float64)
+        report[level] = {
+            'level': get_env_id(level),
+            'episodes': len(level_results),
+            'ignored': len(level_results) - len([result for result in level_results if not result['ignore']]),
+            'score': round(float(scores.mean()), 4),
+            'passed': int((scores >= PASSING_SCORE).sum()),
+            'distance': dict(('p%d' % p, float(np.percentile(distances, p))) for p in PERCENTILES),
+            'time': round(sum(result['time'] for result in level_results), 3),
+        }
+    return report
+
+
+def evaluate(policy='random', levels=None, episodes=1, first_seed=0, processes=None, draw_tiles=False,
+             configure=None, max_steps=10000, callback=None):
+    # Runs episodes for every (level, seed) in a pool of processes - Returns (report, results)
+    # callback(result) is called as soon as each episode is finished
+    levels = list(range(NUM_LEVELS)) if levels is None else list(levels)
+    jobs = [(level, seed) for seed in range(first_seed, first_seed + episodes) for level in levels]
+
+    # Creating the fceux launch lock before the pool, so it is shared by all workers
+    from .nes_env import NesLock
+    NesLock()
+
+    results = []
+    pool = multiprocessing.Pool(
+        processes=processes or os.cpu_count() or 1,
+        initializer=_init_worker,
+        initargs=(policy, draw_tiles, configure, max_steps))
+    try:
+        for result in pool.imap_unordered(run_episode, jobs):
+            results.append(result)
+            if callback is not None:
+                callback(result)
+    finally:
+        pool.close()
+        pool.join()
+    return summarize(results), results
+
+
+def format_report(report, elapsed_time=None):
+    lines = ['%-22s %8s %8s %7s %8s %8s %8s %9s' % ('level', 'episodes', 'score', 'passed', 'p10', 'p50', 'p90', 'time (s)')]
+    for level in sorted(report):
+        row = report[level]
+        lines.append('%-22s %8d %8.1f %7d %8.0f %8.0f %8.0f %9.1f' % (
+            row['level'], row['episodes'], row['score'], row['passed'],
+            row['distance']['p10'], row['distance']['p50'], row['distance']['p90'], row['time']))
+    total_score = sum(row['score'] for row in report.values())
+    lines.append('Total score: %.1f' % total_score)
+    if elapsed_time is not None:
+        lines.append('Wall-clock: %.1f s' % elapsed_time)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluates a policy on Super Mario Bros levels with a pool of processes')
+    parser.add_argument('--policy', default='random', help="'random' or 'module:function' (function(env) returns policy(observation) -> action)")
+    parser.add_argument('--levels', default=None, help="comma separated level numbers (0 to 31), defaults to all levels")
+    parser.add_argument('--episodes', type=int, default=1, help='episodes (seeds) per level')
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--tiles', action='store_true', help='uses the Tiles envs')
+    parser.add_argument('--max-steps', type=int, default=10000)
+    parser.add_argument('--configure', default='{}', help='json kwargs passed to env.configure()')
+    parser.add_argument('--output', default=None, help='writes the report and the episode results to this json file')
+    args = parser.parse_args(argv)
+
+    def print_result(result):
+        print('%s seed %d: distance %d, score %.1f, %d steps, %.1f s%s' % (
+            get_env_id(result['level'], args.tiles), result['seed'], result['distance'], result['score'],
+            result['steps'], result['time'], ' (ignored)' if result['ignore'] else ''))
+
+    start_time = time.time()
+    report, results = evaluate(
+        policy=args.policy,
+        levels=[int(level) for level in args.levels.split(',')] if args.levels else None,
+        episodes=args.episodes,
+        first_seed=args.first_seed,
+        processes=args.processes,
+        draw_tiles=args.tiles,
+        configure=json.loads(args.configure),
+        max_steps=args.max_steps,
+        callback=print_result)
+    elapsed_time = time.time() - start_time
+    print(format_report(report, elapsed_time))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'report': report, 'results': results, 'time': elapsed_time}, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
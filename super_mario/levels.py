@@ -0,0 +1,29 @@
+# Level table - Kept free of gym / numpy / fceux imports, so it can be imported anywhere
+# (world_number, level_number, area_number, max_distance)
+WORLD_NUMBER = 0
+LEVEL_NUMBER = 1
+AREA_NUMBER = 2
+MAX_DISTANCE = 3
+SMB_LEVELS = [
+    (1, 1, 1, 3266), (1, 2, 3, 3266), (1, 3, 4, 2514), (1, 4, 5, 2430),
+    (2, 1, 1, 3298), (2, 2, 3, 3266), (2, 3, 4, 3682), (2, 4, 5, 2430),
+    (3, 1, 1, 3298), (3, 2, 2, 3442), (3, 3, 3, 2498), (3, 4, 4, 2430),
+    (4, 1, 1, 3698), (4, 2, 3, 3266), (4, 3, 4, 2434), (4, 4, 5, 2942),
+    (5, 1, 1, 3282), (5, 2, 2, 3298), (5, 3, 3, 2514), (5, 4, 4, 2429),
+    (6, 1, 1, 3106), (6, 2, 2, 3554), (6, 3, 3, 2754), (6, 4, 4, 2429),
+    (7, 1, 1, 2962), (7, 2, 3, 3266), (7, 3, 4, 3682), (7, 4, 5, 3453),
+    (8, 1, 1, 6114), (8, 2, 2, 3554), (8, 3, 3, 3554), (8, 4, 4, 4989)]
+NUM_LEVELS = len(SMB_LEVELS)
+PASSING_SCORE = 990     # Standardized score of the target distance (40 pixels before the castle)
+
+
+def get_standard_reward(level, value):
+    # Returns a standardized score for an episode (i.e. between 0 and 1,000), from the distance reached
+    # The target distance is the 99th percentile of the scale
+    min_score = 0
+    target_score = float(SMB_LEVELS[level][MAX_DISTANCE]) - 40
+    max_score = min_score + (target_score - min_score) / 0.99
+    std_reward = round(1000 * (value - min_score) / (max_score - min_score), 4)
+    std_reward = min(1000, std_reward)  # Cannot be more than 1,000
+    std_reward = max(0, std_reward)  # Cannot be less than 0
+    return std_reward
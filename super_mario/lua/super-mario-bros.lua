@@ -8,7 +8,10 @@
 -- target = "111";          -- World Number - Level Number - Area Number
 -- mode = "algo";           -- algo, human
 -- draw_tiles = "1";
+-- obs_mode = "screen";     -- screen, or entities (sends the entity table instead of the screen)
 -- meta = "0"               -- meta indicates multiple mission
+-- stats_every = "0";       -- Sends profiling counters every stats_every processed frames (0 to disable)
+-- overlay = "0";           -- 1 to draw the distance and the tiles on the fceux window (always 1 in human mode)
 -- pipe_name = "abc";
 -- pipe_prefix = "/tmp/smb-fifo";
 
@@ -23,9 +26,12 @@
 -- Default values
 mode = mode or "algo";
 draw_tiles = tonumber(draw_tiles) or 0;
+obs_mode = obs_mode or "screen";
 meta = tonumber(meta) or 0;
 pipe_name = pipe_name or "";
 pipe_prefix = pipe_prefix or "";
+overlay = tonumber(overlay) or 0;
+stats_every = tonumber(stats_every) or 0;
 
 -- Parsing world
 if target then
@@ -51,20 +57,25 @@ skip_data = 0;              -- Does not send data to pipe (e.g. human mode)
 skip_tiles = 0;             -- Does not send tiles to pipe (e.g. human mode)
 skip_commands = 0;          -- Do not read commands from pipe (e.g. human mode)
 start_delay = 100;          -- Number of frames to wait before pressing "start" to start level
-send_all_pixels = 702;      -- Return full screen (all pixels) every 700 frames
-force_refresh = 0;          -- Forces to return full screen (all pixels and data) for this number of frames
+keyframe_requested = 0;     -- Sends the full screen and data (requested by python, or first frame after ready)
+scroll_split_row = 24;      -- Screen rows above this row are the status bar, which does not scroll
+screen_left_position = -1;  -- Position of the left of the screen (page * 256 + x) when the screen was last sent
 changing_level = 0;         -- Indicates level change in progress
 curr_x_position = 0;        -- Current x position
 curr_y_position = 0;        -- Current y position
 last_processed_frame = 0;   -- Indicates last frame that was sent to pipe, to wait for commands on that frame number
 commands = {};              -- List of current commands (inputs)
-screen = {};                -- List of current screen pixels
+screen_rows = {};           -- Current screen, one string per row (one byte per pixel, the palette index)
+screen_sums = {};           -- Sums of each screen row (see get_row_sums), nil if not computed
 data = {};                  -- List of current player stats
 tiles = {};                 -- List of tiles
 pipe_in = nil;              -- Input named pipe
 pipe_out = nil;             -- Output named pipe
 running_thread = 0;         -- To avoid 2 threads running at the same time
 commands_rcvd = 0;          -- To indicate that commands were received
+saved_states = {};          -- In-memory savestates by handle (see clonestate / restorestate)
+seed_slot = 10;             -- fceux slot used to exchange the state after the no-ops with the python seed cache
+frame_offset = 0;           -- Added to emu.framecount() in messages, so frame numbers keep increasing after loading a seed state
 
 -- Max distances
 distances = {};
@@ -101,11 +112,29 @@ distances["822"] = 3554;    -- 8-2
 distances["833"] = 3554;    -- 8-3
 distances["844"] = 4989;    -- 8-4
 
+-- Actions (same indexes as ACTIONS_MAPPING in nes_env.py) - up, left, down, right, A, B
+actions_mapping = {};
+actions_mapping[0] = { false, false, false, false, false, false };      -- NOOP
+actions_mapping[1] = { true, false, false, false, false, false };       -- Up
+actions_mapping[2] = { false, false, true, false, false, false };       -- Down
+actions_mapping[3] = { false, true, false, false, false, false };       -- Left
+actions_mapping[4] = { false, true, false, false, true, false };        -- Left + A
+actions_mapping[5] = { false, true, false, false, false, true };        -- Left + B
+actions_mapping[6] = { false, true, false, false, true, true };         -- Left + A + B
+actions_mapping[7] = { false, false, false, true, false, false };       -- Right
+actions_mapping[8] = { false, false, false, true, true, false };        -- Right + A
+actions_mapping[9] = { false, false, false, true, false, true };        -- Right + B
+actions_mapping[10] = { false, false, false, true, true, true };        -- Right + A + B
+actions_mapping[11] = { false, false, false, false, true, false };      -- A
+actions_mapping[12] = { false, false, false, false, false, true };      -- B
+actions_mapping[13] = { false, false, false, false, true, true };       -- A + B
+
 -- Setting mode
 -- Human: Game is played manually by a human (no algo)
 -- Algo (Default): Game is played by algo at high speed
 if mode == "human" then
     emu.speedmode("normal");
+    overlay = 1;
     skip_frames = 1;
     skip_screen = 1;
     skip_data = 1;
@@ -118,7 +147,6 @@ else
     emu.speedmode("maximum");
     skip_frames = 2;
     start_delay = 175;
-    send_all_pixels = 1500;
 end;
 
 -- ===========================
@@ -135,26 +163,42 @@ addr_curr_page = 0x6d;
 addr_curr_x = 0x86;
 addr_curr_y = 0x03b8;
 addr_left_x = 0x071c;
+addr_left_page = 0x071a;
 addr_y_viewport = 0x00b5;
 addr_player_state = 0x000e;     -- x06 dies, x0b dying
 addr_player_status = 0x0756;    -- 0 = small, 1 = big, 2+ = fiery
 addr_enemy_page = 0x6e;
 addr_enemy_x = 0x87;
 addr_enemy_y = 0xcf;
+addr_enemy_flag = 0x0f;         -- 5 enemy slots (0 if the slot is empty)
+addr_enemy_type = 0x16;
+addr_x_speed = 0x57;            -- Object arrays (Mario, then 5 enemies, powerup, 2 fireballs), signed
+addr_y_speed = 0x9f;
+addr_object_page = 0x6d;
+addr_object_x = 0x86;
+addr_object_y = 0xce;
+addr_powerup_flag = 0x14;       -- Powerup is object 6
+addr_powerup_type = 0x39;
+addr_fireball_state = 0x24;     -- Fireballs are objects 7 and 8
 addr_injury_timer = 0x079e;
 addr_swimming_flag = 0x0704;
 addr_tiles = 0x500;
 
+-- Hex strings of 0 to 255 (to avoid string.format in loops)
+hex = {};
+for i=0,255 do
+    hex[i] = string.format("%02x", i);
+end;
+empty_row = string.rep("\255", 256);  -- Row that was never sent (palette indexes are lower than 255)
+
 -- ===========================
 --         Functions
 -- ===========================
 -- Initiating variables
 function reset_vars()
-    for x=0,255 do
-        screen[x] = {};
-        for y=0,223 do
-            screen[x][y] = -1;
-        end;
+    for y=0,223 do
+        screen_rows[y] = empty_row;
+        screen_sums[y] = nil;
     end;
     local data_var = { "distance", "life", "score", "coins", "time", "player_status", "is_finished" };
     for i=1,#data_var do
@@ -176,6 +220,7 @@ function reset_vars()
     curr_x_position = 0;
     curr_y_position = 0;
     last_processed_frame = 0;
+    screen_left_position = -1;
     max_distance = distances[target] or 0;
 end;
 
@@ -199,6 +244,13 @@ function split(self, delimiter)
     return results;
 end;
 
+-- get_frame - Returns the frame number used in messages and commands
+-- Loading a seed state restores the frame count of the game that saved it, frame_offset keeps the frame numbers
+-- as if the no-ops had been run
+function get_frame()
+    return emu.framecount() + frame_offset;
+end;
+
 -- readbyterange - Reads a range of bytes and return a number
 function readbyterange(address, length)
   local return_value = 0;
@@ -263,6 +315,12 @@ function get_left_x_position()
     return (memory.readbyte(addr_curr_x) - memory.readbyte(addr_left_x)) % 256;
 end;
 
+-- get_screen_left_position - Returns the position of the left of the screen in the level (scroll position)
+-- A frame is rendered with the scroll position of the previous frame, so it must be read before emu.frameadvance()
+function get_screen_left_position()
+    return memory.readbyte(addr_left_page) * 0x100 + memory.readbyte(addr_left_x);
+end;
+
 -- get_y_position - Returns the current (vertical) position
 function get_y_position()
     return memory.readbyte(addr_curr_y);
@@ -337,6 +395,41 @@ function get_enemies()
     return enemies;
 end;
 
+-- get_entities - Sends the entity table (Mario, 5 enemy slots, powerup, 2 fireballs) from one read of the zero page
+-- Each entity is a fixed 8-byte record: kind, type, x (2 bytes, little-endian, position in the level), y (on screen),
+-- x speed, y speed (signed bytes), active. Inactive entities only have their kind set
+-- Kind: 1 - Mario, 2 - Enemy, 3 - Powerup, 4 - Fireball
+-- Format: entities_<frame_number>#<16 hex digits per entity>
+function get_entities()
+    if obs_mode ~= "entities" then
+        return;
+    end;
+    local ram = memory.readbyterange(0x00, 0x100);
+    local byte = string.byte;
+    local records = {};
+    for i=0,8 do
+        local kind, entity_type, active;
+        if i == 0 then
+            kind, entity_type, active = 1, get_player_status(), 1;
+        elseif i <= 5 then
+            kind, entity_type, active = 2, byte(ram, addr_enemy_type + i), byte(ram, addr_enemy_flag + i);
+        elseif i == 6 then
+            kind, entity_type, active = 3, byte(ram, addr_powerup_type + 1), byte(ram, addr_powerup_flag + 1);
+        else
+            kind, entity_type, active = 4, 0, byte(ram, addr_fireball_state + i - 6);
+        end;
+        if active ~= 0 then
+            records[#records + 1] = hex[kind] .. hex[entity_type] .. hex[byte(ram, addr_object_x + i + 1)]
+                .. hex[byte(ram, addr_object_page + i + 1)] .. hex[byte(ram, addr_object_y + i + 1)]
+                .. hex[byte(ram, addr_x_speed + i + 1)] .. hex[byte(ram, addr_y_speed + i + 1)] .. "01";
+        else
+            records[#records + 1] = hex[kind] .. "00000000000000";
+        end;
+    end;
+    write_to_pipe("entities_" .. get_frame() .. "#" .. table.concat(records));
+    return;
+end;
+
 -- get_distance_perc - Returns the percentage of the world currently completed (as a string with % sign)
 function get_distance_perc(current_distance, max_distance)
     -- For some maps, underground tunnels use a page location after the finish line
@@ -355,6 +448,9 @@ end;
 
 -- show_curr_distance - Displays the current distance on the map with percentage
 function show_curr_distance()
+    if overlay == 0 then
+        return;
+    end;
     local distance = "Distance " .. curr_x_position;
     distance = distance .. " (" .. get_distance_perc(curr_x_position, max_distance) .. ")";
     return emu.message(distance);
@@ -370,7 +466,7 @@ function get_data()
         return;
     end;
 
-    local framecount = emu.framecount();
+    local framecount = get_frame();
     local data_count = 0;
     local data_string = "";
     local curr_life = get_life();
@@ -378,39 +474,40 @@ function get_data()
     local curr_coins = get_coins();
     local curr_time = get_time();
     local curr_player_status = get_player_status();
-    
+    local refresh = (keyframe_requested == 1);
+
     -- Checking what values have changed
-    if (framecount % send_all_pixels == 0) or (curr_x_position ~= data["distance"]) or (force_refresh > 0) then
+    if refresh or (curr_x_position ~= data["distance"]) then
         data["distance"] = curr_x_position;
         data_string = data_string .. "|distance:" .. curr_x_position;
         data_count = data_count + 2;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_life ~= data["life"]) or (force_refresh > 0) then
+    if refresh or (curr_life ~= data["life"]) then
         data["life"] = curr_life;
         data_string = data_string .. "|life:" .. curr_life;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_score ~= data["score"]) or (force_refresh > 0) then
+    if refresh or (curr_score ~= data["score"]) then
         data["score"] = curr_score;
         data_string = data_string .. "|score:" .. curr_score;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_coins ~= data["coins"]) or (force_refresh > 0) then
+    if refresh or (curr_coins ~= data["coins"]) then
         data["coins"] = curr_coins;
         data_string = data_string .. "|coins:" .. curr_coins;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_time ~= data["time"]) or (force_refresh > 0) then
+    if refresh or (curr_time ~= data["time"]) then
         data["time"] = curr_time;
         data_string = data_string .. "|time:" .. curr_time;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_player_status ~= data["player_status"]) or (force_refresh > 0) then
+    if refresh or (curr_player_status ~= data["player_status"]) then
         data["player_status"] = curr_player_status;
         data_string = data_string .. "|player_status:" .. curr_player_status;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (is_finished ~= data["is_finished"]) or (force_refresh > 0) then
+    if refresh or (is_finished ~= data["is_finished"]) then
         data["is_finished"] = is_finished;
         data_string = data_string .. "|is_finished:" .. is_finished;
         data_count = data_count + 1;
@@ -418,8 +515,9 @@ function get_data()
     
     -- Removing leading "|" if data has changed, otherwise not returning anything
     if data_count > 0 then
-        if is_finished == 1 then
+        if (is_finished == 1) and not has_saved_states() then
             -- Indicates to the listening thread to also exit after parsing command
+            -- (unless a saved state can still be restored)
             data_string = data_string .. "|exit";
         end;
         write_to_pipe("data_" .. framecount .. "#" .. string.sub(data_string, 2, -1));
@@ -427,40 +525,104 @@ function get_data()
     return;
 end;
 
+-- shift_screen - Shifts the screen cache dx pixels to the left (except the status bar rows)
+-- Columns exposed on the right are set to 255 (never sent), so they are sent with the screen
+function shift_screen(dx)
+    local filler = string.sub(empty_row, 1, dx);
+    for y=scroll_split_row,223 do
+        screen_rows[y] = string.sub(screen_rows[y], dx + 1) .. filler;
+        screen_sums[y] = nil;
+    end;
+    return;
+end;
+
+-- get_row_sums - Returns the sum of the pixels of a row, and their sum weighted by (256 - x)
+-- The adler-32 sums of the screen are computed from the row sums, so unchanged rows are not summed again
+function get_row_sums(pixels)
+    local row_sum = 0;
+    local weighted_sum = 0;
+    for i=1,256 do
+        local p = pixels[i];
+        row_sum = row_sum + p;
+        weighted_sum = weighted_sum + (257 - i) * p;
+    end;
+    return { row_sum, weighted_sum };
+end;
+
 -- get_screen - Returns the current RGB data for the screen (256 x 224)
--- Only returns pixels that have changed since last frame update
+-- Only returns pixels that have changed since last frame update, followed by a checksum of the whole screen
+-- If the screen scrolled to the right, the scroll is sent first and the previous screen is shifted before comparing,
+-- so only the exposed columns and the moving sprites are sent
+-- left_position is the scroll position used to render the frame (read before emu.frameadvance())
+-- Format: scroll_<frame_number>#<number of pixels>
 -- Format: screen_<frame_number>#<x(2 hex digits)><y (2 hex digits)><palette (2 hex digits)>|...
+-- Format: checksum_<frame_number>#<adler-32 of the palette indexes, row by row>
 -- Palette is a number from 0 to 127 that represents an RGB color (conversion table in python file)
-function get_screen()
+function get_screen(left_position)
 
-    -- Skipping screen is skip_screen is set or draw_tiles if set
-    if (skip_screen == 1) or (draw_tiles == 1) then
+    -- Skipping screen is skip_screen is set or draw_tiles if set (or in entities mode)
+    if (skip_screen == 1) or (draw_tiles == 1) or (obs_mode == "entities") then
         return;
     end;
 
-    local r, g, b, p;
-    local framecount = emu.framecount();
+    local getscreenpixel = emu.getscreenpixel;
+    local framecount = get_frame();
+    local refresh = (keyframe_requested == 1);
+
+    -- Compensating the scroll
+    left_position = left_position or get_screen_left_position();
+    local dx = left_position - screen_left_position;
+    if (not refresh) and (screen_left_position >= 0) and (dx > 0) and (dx < 256) then
+        shift_screen(dx);
+        write_to_pipe("scroll_" .. framecount .. "#" .. dx);
+    end;
+    screen_left_position = left_position;
+
+    -- Adler-32 sums (the modulo is only applied at the end, sums stay below 2^53)
+    -- Pixel i (1 to 57344) is counted 57345 - i times in sum_b, i.e. 256 * (223 - y) + (256 - x) times
+    local sum_a = 1;
+    local sum_b = 57344;
+    local pixels = {};
     -- NES only has y values in the range 8 to 231, so we need to offset y values by 8
     local offset_y = 8;
     for y=0,223 do
-        local screen_string = "";
-        local data_count = 0;
+        local screen_y = y + offset_y;
         for x=0,255 do
-            r, g, b, p = emu.getscreenpixel(x, y + offset_y, false);
-            if (framecount % send_all_pixels == 0) or (p ~= screen[x][y]) or (force_refresh > 0) then
-                screen[x][y] = p;
-                screen_string = screen_string .. "|" .. string.format("%02x%02x%02x", x, y, p);
-                data_count = data_count + 1;
+            local _, _, _, p = getscreenpixel(x, screen_y, false);
+            pixels[x + 1] = p;
+        end;
+        local row = string.char(unpack(pixels));
+        local sums = screen_sums[y];
+
+        -- Only comparing pixels of rows that changed
+        if refresh or (row ~= screen_rows[y]) then
+            local buffer = {};
+            local hex_y = hex[y];
+            local old_pixels = { string.byte(screen_rows[y], 1, 256) };
+            for i=1,256 do
+                local p = pixels[i];
+                if refresh or (p ~= old_pixels[i]) then
+                    buffer[#buffer + 1] = hex[i - 1] .. hex_y .. hex[p];
+                end;
+            end;
+            if #buffer > 0 then
+                write_to_pipe("screen_" .. framecount .. "#" .. table.concat(buffer, "|"));
             end;
+            screen_rows[y] = row;
+            sums = nil;
         end;
-        if data_count > 0 then
-            write_to_pipe("screen_" .. framecount .. "#" .. string.sub(screen_string, 2, -1));
+        if not sums then
+            sums = get_row_sums(pixels);
+            screen_sums[y] = sums;
         end;
+        sum_a = sum_a + sums[1];
+        sum_b = sum_b + 256 * (223 - y) * sums[1] + sums[2];
     end;
+    write_to_pipe("checksum_" .. framecount .. "#" .. string.format("%.0f", (sum_b % 65521) * 65536 + (sum_a % 65521)));
     return;
 end;
 
--- get_tiles - Returns tiles data (and displays them on screen)
+-- get_tiles - Returns tiles data (and displays them on screen if overlay is 1)
 -- Only returns tiles that have changed since last update
 -- Format: tiles_<frame_number>#<x(1 hex digits)><y (1 hex digits)><value (1 hex digits)>|...
 -- Value: 0 - Empty space, 1 - Object / Other, 2 - Enemy, 3 - Mario
@@ -471,26 +633,34 @@ function get_tiles()
         return;
     end;
     
+    -- Only drawing on skipped frames (nothing to draw without overlay)
+    local framecount = get_frame();
+    local is_sending = (emu.framecount() % skip_frames == 0) and (skip_tiles == 0);
+    if (not is_sending) and (overlay == 0) then
+        return;
+    end;
+
     local enemies = get_enemies();
     local left_x = get_left_x_position();
     local y_viewport = get_y_viewport();
-    local framecount = emu.framecount();
-    
+    local refresh = (keyframe_requested == 1);
+
     -- Outside box (80 x 65 px)
     -- Will contain a matrix of 16x13 sub-boxes of 5x5 pixels each
-    gui.box(
-        50 - 5 * 7 - 2,
-        70 - 5 * 7 - 2,
-        50 + 5 * 8 + 3,
-        70 + 5 * 5 + 3,
-        0,
-        "P30"
-    );       -- P30 = White (NES Palette 30 color)
-  
+    if overlay == 1 then
+        gui.box(
+            50 - 5 * 7 - 2,
+            70 - 5 * 7 - 2,
+            50 + 5 * 8 + 3,
+            70 + 5 * 5 + 3,
+            0,
+            "P30"
+        );       -- P30 = White (NES Palette 30 color)
+    end;
+
     -- Calculating tile types
     for box_y = -4*16,8*16,16 do
-        local tile_string = "";
-        local data_count = 0;
+        local buffer = {};
         for box_x = -7*16,8*16,16 do
       
             -- 0 = Empty space
@@ -529,25 +699,23 @@ function get_tiles()
             local tile_x = 50 + 5 * (box_x / 16);
             local tile_y = 55 + 5 * (box_y / 16);
             
-            if (tile_value ~= 0) then
+            if (tile_value ~= 0) and (overlay == 1) then
                 gui.box(tile_x - 2, tile_y - 2, tile_x + 2, tile_y + 2, fill, color);
             end;
             
             -- Storing value only on processed frames
             -- Only sending values for processed frames if skip_tiles is 0
             -- Skipped frames (where commands are not processed) have box drawn, but no values sent
-            if (framecount % skip_frames == 0) and (skip_tiles == 0) then
+            if is_sending then
                 -- Only returning value if tile value has changed (or full refresh needed)
-                if (framecount % send_all_pixels == 0) or (tile_value ~= tiles[(box_x / 16) + 7][(box_y / 16) + 4]) or (force_refresh > 0) then
+                if refresh or (tile_value ~= tiles[(box_x / 16) + 7][(box_y / 16) + 4]) then
                     tiles[(box_x / 16) + 7][(box_y / 16) + 4] = tile_value;
-                    --noinspection StringConcatenationInLoops
-                    tile_string = tile_string .. "|" .. string.format("%01x%01x%01x", (box_x / 16) + 7, (box_y / 16) + 4, tile_value);
-                    data_count = data_count + 1;
+                    buffer[#buffer + 1] = string.format("%01x%01x%01x", (box_x / 16) + 7, (box_y / 16) + 4, tile_value);
                 end;
             end;
         end;
-        if data_count > 0 then
-            write_to_pipe("tiles_" .. framecount .. "#" .. string.sub(tile_string, 2, -1));
+        if #buffer > 0 then
+            write_to_pipe("tiles_" .. framecount .. "#" .. table.concat(buffer, "|"));
         end;
     end;
     return;
@@ -571,14 +739,16 @@ function check_if_started()
             is_started = 1;
             last_time_left = 0;
             pipe_out, _, _ = io.open(pipe_prefix .. "-in." .. pipe_name, "w");
-            write_to_pipe("ready_" .. emu.framecount());
-            force_refresh = 5;  -- Sending full screen for next 5 frames, then only diffs
+            write_to_pipe("ready_" .. get_frame());
             update_positions();
             show_curr_distance();
             get_tiles();
             get_data();
             -- get_screen();    -- Was blocking execution
             ask_for_commands();
+            -- Sending full screen, tiles and data on the first processed frame (python ignores the data sent with ready)
+            -- The flag is cleared by ask_for_commands(), so it holds however many loop iterations the first command takes
+            keyframe_requested = 1;
         else
             last_time_left = time_left;
         end;
@@ -586,14 +756,20 @@ function check_if_started()
     return;
 end;
 
--- check_if_finished - Checks if the level is finished (life lost, finish line crossed, level increased)
+-- get_is_level_finished - Returns true if the level is finished (life lost, finish line crossed, level increased)
 -- The target (reward_threshold) is 40 pixels before the castle
 -- The finish line (where the game will automatically close) is 15 pixels before the castle
-function check_if_finished()
-    if (get_is_dead() == 1)
+function get_is_level_finished()
+    return (get_is_dead() == 1)
         or ((curr_x_position >= max_distance - 15) and (curr_x_position <= max_distance))
         or (get_life() < 3)
-        or (get_level() > 4 * (target_world - 1) + (target_level - 1)) then
+        or (get_level() > 4 * (target_world - 1) + (target_level - 1));
+end;
+
+-- check_if_finished - Checks if the level is finished (life lost, finish line crossed, level increased)
+function check_if_finished()
+    update_positions();     -- Positions are not updated on skipped frames
+    if get_is_level_finished() then
         -- Level finished
         -- is_finished will be written to pipe with the get_data() function
         is_started = 0;
@@ -603,22 +779,145 @@ function check_if_finished()
         read_commands();
         if commands_rcvd == 1 then
             commands_rcvd = 0
+            local left_position = get_screen_left_position();
             emu.frameadvance();
             update_positions();
             show_curr_distance();
             get_tiles();
             get_data();
-            get_screen();
+            get_screen(left_position);
+            get_entities();
             ask_for_commands();
+        elseif commands_rcvd == 2 then
+            -- Sequence already processed
+            commands_rcvd = 0;
+            ask_for_commands();
+        end;
+    end;
+    return;
+end;
+
+-- run_sequence - Runs a list of actions back to back (each action is held for skip_frames frames, like in step)
+-- Sends the data of every step in a single message, and the screen only every 'every' steps and on the last step
+-- The sequence stops when the level is finished, or when Mario is stuck (same rule as the python reward engine:
+-- the max distance has not increased for stuck_duration, starting from the max distance and time sent by python)
+-- Format: seq_<frame_number>#<distance>,<life>,<score>,<coins>,<time>,<player_status>,<is_finished>|...
+-- Format: obs_<frame_number> (sent after the screen of intermediate steps)
+function run_sequence(every, actions, stuck_duration, last_max_distance, last_max_distance_time)
+    local records = {};
+    local is_stuck = false;
+    local left_position;
+    local commands_var = { "up", "left", "down", "right", "A", "B" };
+    for i=1,#actions do
+        local action = actions_mapping[tonumber(actions[i])] or actions_mapping[0];
+        for j=1,#commands_var do
+            commands[commands_var[j]] = action[j];
+        end;
+        for f=1,skip_frames do
+            left_position = get_screen_left_position();
+            joypad.set(1, commands);
+            emu.frameadvance();
+        end;
+        update_positions();
+        if get_is_level_finished() then
+            is_started = 0;
+            is_finished = 1;
+        end;
+        local curr_time = get_time();
+        if curr_x_position > last_max_distance then
+            last_max_distance = curr_x_position;
+            last_max_distance_time = curr_time;
+        elseif (stuck_duration ~= nil) and (math.abs(curr_time - last_max_distance_time) >= stuck_duration) then
+            is_stuck = true;
+        end;
+        records[#records + 1] = curr_x_position .. "," .. get_life() .. "," .. get_score() .. "," .. get_coins() .. ","
+            .. curr_time .. "," .. get_player_status() .. "," .. is_finished;
+        if (is_finished == 1) or is_stuck or (i == #actions) then
+            break;
+        end;
+        if (every > 0) and (i % every == 0) then
+            get_tiles();
+            get_screen(left_position);
+            get_entities();
+            write_to_pipe("obs_" .. get_frame());
+            keyframe_requested = 0;
+        end;
+    end;
+    write_to_pipe("seq_" .. get_frame() .. "#" .. table.concat(records, "|"));
+    show_curr_distance();
+    get_tiles();
+    get_data();
+    get_screen(left_position);
+    get_entities();
+    return;
+end;
+
+-- has_saved_states - Returns true if at least one state can be restored (see clonestate)
+function has_saved_states()
+    return next(saved_states) ~= nil;
+end;
+
+-- copy_table - Returns a copy of a table (nested tables are copied up to depth levels)
+function copy_table(source, depth)
+    local copy = {};
+    for key, value in pairs(source) do
+        if (type(value) == "table") and (depth or 1) > 1 then
+            copy[key] = copy_table(value, depth - 1);
+        else
+            copy[key] = value;
         end;
     end;
+    return copy;
+end;
+
+-- clone_state - Saves the current state in memory, with the screen, data and tiles last sent
+-- (python saves its copy with the state, so only the diffs are sent after a restore)
+function clone_state(handle)
+    local state = savestate.object();
+    savestate.save(state);
+    saved_states[handle] = {
+        state = state,
+        commands = copy_table(commands),
+        screen_rows = copy_table(screen_rows),
+        screen_sums = copy_table(screen_sums),
+        screen_left_position = screen_left_position,
+        data = copy_table(data),
+        tiles = copy_table(tiles, 2)
+    };
+    return;
+end;
+
+-- restore_state - Restores a state saved with clone_state
+-- Format: restored_<frame_number>#<handle> (handle is -1 if the state does not exist)
+function restore_state(handle)
+    local saved = saved_states[handle];
+    if not saved then
+        write_to_pipe("restored_" .. get_frame() .. "#-1");
+        return;
+    end;
+    savestate.load(saved.state);
+    commands = copy_table(saved.commands);
+    screen_rows = copy_table(saved.screen_rows);
+    screen_sums = copy_table(saved.screen_sums);
+    screen_left_position = saved.screen_left_position;
+    data = copy_table(saved.data);
+    tiles = copy_table(saved.tiles, 2);
+    joypad.set(1, commands);
+    is_started = 1;
+    is_finished = 0;
+    changing_level = 0;
+    commands_rcvd = 0;
+    update_positions();
+    last_processed_frame = get_frame();
+    write_to_pipe("restored_" .. last_processed_frame .. "#" .. handle);
     return;
 end;
 
 -- ask_for_commands - Mark the current frame has processed (to listen for matching command)
 function ask_for_commands()
-    local framecount = emu.framecount();
+    local framecount = get_frame();
     last_processed_frame = framecount;
+    keyframe_requested = 0;
     write_to_pipe("done_" .. framecount);
 end;
 
@@ -641,6 +940,14 @@ end;
 
 -- parse_commands() - Parse received commands
 -- Format: commands_<frame number>#up,left,down,right,a,b (e.g. commands_21345#0,0,0,1,1,0)
+-- Format: commands_next#up,left,down,right,a,b (pipelined mode, applied to the next processed frame)
+-- Format: sequence_<frame number>#<every>:<action 1>,<action 2>,...:<stuck_duration>,<last max distance>,<last max distance time>
+--         (ACTIONS_MAPPING indexes, and the stuck tracking state of python, see run_sequence)
+-- Format: keyframe_<frame number> (sends the full screen and data on the next processed frame)
+-- Format: noop_<frame number>#<noop count>[:load|:save] (no-ops at the start of the level, see the seed cache)
+-- Format: clonestate_<frame number>#<handle> (saves the current state in memory)
+-- Format: restorestate_<frame number>#<handle> (restores a saved state, replies with restored_<frame number>#<handle>)
+-- Format: freestate#<handle> (frees a saved state)
 -- Format: changelevel#<level_number> (e.g. changelevel#22) (level number is a number from 0 to 31)
 -- Format: exit
 function parse_commands(line)
@@ -654,7 +961,7 @@ function parse_commands(line)
 
     -- Deciding what command to execute
     -- Setting joypad
-    if ("commands" == command) and (tonumber(frame_number) == last_processed_frame) then
+    if ("commands" == command) and ((tonumber(frame_number) == last_processed_frame) or ("next" == frame_number)) then
         commands_rcvd = 1;
         parts = split(data, ",");
         commands["up"] = ((parts[1] == "1") or (parts[1] == "true"));
@@ -667,9 +974,20 @@ function parse_commands(line)
         commands["select"] = false;
         joypad.set(1, commands);
 
+    -- Running a sequence of actions
+    elseif ("sequence" == command) and (tonumber(frame_number) == last_processed_frame) then
+        local sequence_parts = split(data, ":");
+        local stuck_parts = split(sequence_parts[3] or "", ",");
+        run_sequence(tonumber(sequence_parts[1]) or 0, split(sequence_parts[2] or "", ","),
+            tonumber(stuck_parts[1]), tonumber(stuck_parts[2]) or 0, tonumber(stuck_parts[3]) or 0);
+        commands_rcvd = 2;
+
     -- Noop at beginning of level (to simulate seed)
+    -- With the python seed cache, the state after the no-ops is loaded from (load) or saved to (save) the seed slot
     elseif ("noop" == command) and (tonumber(frame_number) == last_processed_frame) then
-        local noop_count = tonumber(data);
+        local noop_parts = split(data, ":");
+        local noop_count = tonumber(noop_parts[1]) or 0;
+        local seed_option = noop_parts[2] or "";
         commands["up"] = false;
         commands["left"] = false;
         commands["down"] = false;
@@ -679,11 +997,33 @@ function parse_commands(line)
         commands["start"] = false;
         commands["select"] = false;
         joypad.set(1, commands);
-        if noop_count > 0 then
+        local frame = get_frame();
+        if ("load" == seed_option) and pcall(savestate.load, savestate.object(seed_slot)) then
+            frame_offset = frame + noop_count - emu.framecount();
+        elseif noop_count > 0 then
             for i=1,noop_count,1 do
                 emu.frameadvance();
             end;
         end;
+        if "save" == seed_option then
+            -- Written to the slot file, python copies it in the seed cache when it receives seedsaved
+            local seed_state = savestate.object(seed_slot);
+            savestate.save(seed_state);
+            savestate.persist(seed_state);
+            write_to_pipe("seedsaved_" .. get_frame() .. "#" .. noop_count);
+        end;
+
+    -- Full screen and data requested (checksum mismatch or dropped message)
+    elseif "keyframe" == command then
+        keyframe_requested = 1;
+
+    -- Saving, restoring and freeing in-memory states (tree search)
+    elseif ("clonestate" == command) and (tonumber(frame_number) == last_processed_frame) then
+        clone_state(data);
+    elseif "restorestate" == command then
+        restore_state(data);
+    elseif "freestate" == command then
+        saved_states[data] = nil;
 
     -- Changing level
     elseif ("changelevel" == command) and (tonumber(data) >= 0) and (tonumber(data) <= 31) then
@@ -778,6 +1118,90 @@ function exit_hook()
 end;
 emu.registerexit(exit_hook);
 
+-- ===========================
+--         Profiling
+-- ===========================
+-- Counters since the last stats message (times are cpu times measured with os.clock, in seconds)
+-- commands_cpu is the cpu time of read_commands(), the time blocked on the pipe waiting for python is not counted
+-- (it is roughly wall - cpu, see the python side)
+-- The functions are only wrapped if stats_every > 0
+-- Format: stats_<frame_number>#name_1:value_1|name_2:value_2|... (times in ms)
+stats_times = { "frameadvance", "screen", "entities", "tiles", "data", "commands_cpu", "cpu" };
+stats_counts = { "frames", "processed", "skipped", "bytes", "messages" };
+stats = {};
+stats_clock = os.clock();
+
+function reset_stats()
+    for i=1,#stats_times do
+        stats[stats_times[i]] = 0;
+    end;
+    for i=1,#stats_counts do
+        stats[stats_counts[i]] = 0;
+    end;
+end;
+
+-- profile - Returns fn, wrapped to add its cpu time to stats[name]
+function profile(name, fn)
+    return function(...)
+        local start = os.clock();
+        local result = fn(...);
+        stats[name] = stats[name] + os.clock() - start;
+        return result;
+    end;
+end;
+
+-- send_stats - Sends the counters, and resets them
+function send_stats()
+    local clock = os.clock();
+    stats["cpu"] = clock - stats_clock;
+    stats["skipped"] = stats["frames"] - stats["processed"];
+    stats_clock = clock;
+    local parts = {};
+    for i=1,#stats_times do
+        parts[#parts + 1] = stats_times[i] .. ":" .. string.format("%.3f", 1000 * stats[stats_times[i]]);
+    end;
+    for i=1,#stats_counts do
+        parts[#parts + 1] = stats_counts[i] .. ":" .. stats[stats_counts[i]];
+    end;
+    reset_stats();
+    write_to_pipe("stats_" .. get_frame() .. "#" .. table.concat(parts, "|"));
+end;
+
+if stats_every > 0 then
+    reset_stats();
+    local frameadvance = emu.frameadvance;
+    emu.frameadvance = function()
+        local start = os.clock();
+        frameadvance();
+        stats["frameadvance"] = stats["frameadvance"] + os.clock() - start;
+        stats["frames"] = stats["frames"] + 1;
+    end;
+    get_screen = profile("screen", get_screen);
+    get_entities = profile("entities", get_entities);
+    get_tiles = profile("tiles", get_tiles);
+    get_data = profile("data", get_data);
+    read_commands = profile("commands_cpu", read_commands);
+
+    local write = write_to_pipe;
+    write_to_pipe = function(data)
+        if data and pipe_out then
+            stats["bytes"] = stats["bytes"] + #data + 2;
+            stats["messages"] = stats["messages"] + 1;
+        end;
+        write(data);
+    end;
+
+    -- Stats are sent before done, so python has them when the step returns
+    local ask = ask_for_commands;
+    ask_for_commands = function()
+        stats["processed"] = stats["processed"] + 1;
+        if stats["processed"] >= stats_every then
+            send_stats();
+        end;
+        ask();
+    end;
+end;
+
 -- ===========================
 --      ** DEBUG **
 -- ===========================
@@ -847,27 +1271,39 @@ function main_loop()
         read_commands();
         if commands_rcvd == 1 then
             commands_rcvd = 0
+            local left_position = get_screen_left_position();
             emu.frameadvance();
             update_positions();
             show_curr_distance();
             get_tiles();
             get_data();
-            get_screen();
+            get_screen(left_position);
+            get_entities();
+            ask_for_commands();
+        elseif commands_rcvd == 2 then
+            -- Sequence already processed (see run_sequence)
+            commands_rcvd = 0;
             ask_for_commands();
         end;
 
-    -- Skipped frame, using same command as last frame, not returning screen
+    -- Skipped frame, using same command as last frame, not returning screen (only drawing the overlay)
     else
         joypad.set(1, commands);
         emu.frameadvance();
-        update_positions();
-        show_curr_distance();
-        get_tiles();
+        if overlay == 1 then
+            update_positions();
+            show_curr_distance();
+            get_tiles();
+        end;
     end;
 
     -- Exiting if game is finished
     if (1 == is_finished) then
-        if 0 == meta then
+        if (0 == meta) and has_saved_states() then
+            -- Single Mission - Waiting for a saved state to be restored (or freed)
+            read_commands();
+
+        elseif 0 == meta then
             -- Single Mission
             for i=1,20,1 do         -- Gives python a couple of ms to process it
                 emu.frameadvance();
@@ -887,8 +1323,6 @@ function main_loop()
         end;
 
     end;
-    force_refresh = force_refresh - 1;
-    if force_refresh < 0 then force_refresh = 0; end;
     running_thread = 0;
 end;
 
@@ -2,12 +2,13 @@ import copy
 import logging
 import os
 import multiprocessing
+import shutil
 import signal
 import subprocess
 import tempfile
-from distutils import spawn
+from collections import OrderedDict, deque
 from threading import Thread, Lock
-from time import sleep
+from time import sleep, thread_time, perf_counter
 
 import numpy as np
 
@@ -15,14 +16,14 @@ import gym
 from gym import utils, spaces
 from gym.utils import seeding
 
-PENALTY_NOT_MOVING = 1     # Penalty when not moving
-DEFAULT_REWARD_DEATH = -2  # Negative reward when Mario dies
-DISTANCE_START = 40        # Distance at which Mario starts in the level
-STUCK_DURATION = 100       # Duration limit for Mario to get stuck in seconds
-SEARCH_PATH = os.pathsep.join([os.environ['PATH'], '/usr/games', '/usr/local/games'])
-FCEUX_PATH = spawn.find_executable('fceux', SEARCH_PATH)
-if FCEUX_PATH is None:
-    raise gym.error.DependencyNotInstalled("fceux is required. Try installing with apt-get install fceux.")
+from .placement import parse_cpus, set_affinity, set_nice, find_pid, get_process_cpu_time
+from .standby import StandbyPool
+from .spectator import SpectatorTap, DEFAULT_ADDRESS, DEFAULT_FPS, DEFAULT_DOWNSAMPLE
+from .reward import DEFAULT_REWARD_DEATH, DISTANCE_START, STUCK_DURATION, compute_reward, compute_rewards
+from .reward import PENALTY_NOT_MOVING  # noqa: F401 (re-exported)
+
+SEARCH_PATH = os.pathsep.join([os.environ.get('PATH', ''), '/usr/games', '/usr/local/games'])
+FCEUX_PATH = None          # Found on first env construction (see get_fceux_path)
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +45,20 @@ ACTIONS_MAPPING = {
     13: [0, 0, 0, 0, 1, 1],  # A + B
 }
 
+def get_fceux_path():
+    # Returns the path to fceux - Only checked when an env is constructed, so the module can be imported without fceux
+    global FCEUX_PATH
+    if FCEUX_PATH is None:
+        FCEUX_PATH = shutil.which('fceux', path=SEARCH_PATH)
+        if FCEUX_PATH is None:
+            raise gym.error.DependencyNotInstalled("fceux is required. Try installing with apt-get install fceux.")
+    return FCEUX_PATH
+
+# Attributes of a launched game, taken over from a standby spare (see StandbyPool)
+SESSION_ATTRIBUTES = ['subprocess', 'temp_lua_path', 'fceux_pid', 'fceux_home', 'pipe_name', 'path_pipe_in', 'path_pipe_out',
+                      'pipe_out', 'pipe_owner', 'is_initialized', 'last_frame', 'info', 'keyframe_needed', 'listener_cpu_time']
+SEED_SLOT = 10          # fceux slot used by the game to save and load the state after the no-ops (see the seed cache)
+
 # Singleton pattern
 class NesLock:
     class __NesLock:
@@ -62,6 +77,7 @@ class NesEnv(gym.Env, utils.EzPickle):
 
     def __init__(self):
         utils.EzPickle.__init__(self)
+        self.fceux_path = get_fceux_path()
         self.fceux_tmp_dir = tempfile.mkdtemp()
         self.rom_path = ''
         self.screen_height = 224
@@ -77,6 +93,7 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.subprocess = None
         self.no_render = True
         self.viewer = None
+        self.spectator = None       # SpectatorTap publishing the screen (see attach_spectator)
 
         # Pipes
         self.pipe_name = ''
@@ -84,7 +101,14 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.path_pipe_in = ''      # Input pipe (maps to fceux out-pipe and to 'in' file)
         self.path_pipe_out = ''     # Output pipe (maps to fceux in-pipe and to 'out' file)
         self.pipe_out = None
+        self.pipe_owner = [self]        # Env receiving the messages of the listening thread (changed by _adopt_standby)
         self.lock_out = Lock()
+        self.fceux_pid = None           # Pid of fceux (not of the shell that launched it), found when needed
+        self.fceux_home = ''            # FCEUX_HOME of the running game ('' if fceux uses the home of the user)
+        self.listener_cpu_time = 0      # Cpu time used by the listening thread (in seconds)
+        self.keyframe_needed = False    # Screen out of sync with the game (checksum mismatch or dropped message)
+        self.keyframe_count = 0         # Number of keyframes requested
+        self.wait_time = 0              # Time spent waiting for the game in step_wait() (in seconds)
         self.disable_in_pipe = False
         self.disable_out_pipe = False
         self.launch_vars['pipe_name'] = ''
@@ -99,24 +123,142 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.is_finished = False
         self.last_max_distance = 0
         self.last_max_distance_time = 0
-        self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        self.dead = False           # Result of the reward engine for the last step
+        self.stuck = False          # Result of the reward engine for the last step
+        self.game_stuck = False     # The game stopped responding and was terminated (the step reports info['ignore'])
+        self._clear_screen()
         self.info = {}
         self.old_info = {}
         self.level = 0
         self._reset_info_vars()
         self.first_step = False
         self.lock = (NesLock()).get_lock()
+        self._pending_steps = deque()   # Start frames of actions sent with step_async(), or ready-made results
+        self._frame_results = deque()   # (info, state, is_finished) captured when frames are done (pipelined mode)
 
         self.temp_lua_path = ""
 
+        # Seed cache - States after the no-ops by (level, seed), least recently used first (see _get_noop_option)
+        self.seed_cache_home = ''       # FCEUX_HOME of the next games launched ('' if the seed cache is disabled)
+        self.seed_states = OrderedDict()
+        self.seed_cache_hits = 0
+        self.seed_cache_misses = 0
+        self._saving_seed_key = None    # (level, seed) of the state the game was asked to save
+
         # Seeding
         self.curr_seed = 0
         self.seed()
         self._configure()
 
-    def _configure(self, reward_death=DEFAULT_REWARD_DEATH, stuck_duration=STUCK_DURATION):
+    def configure(self, *args, **kwargs):
+        # gym no longer forwards configure() to _configure()
+        return self._configure(*args, **kwargs)
+
+    def _configure(self, reward_death=DEFAULT_REWARD_DEATH, stuck_duration=STUCK_DURATION, reward_shaping=None, pipelined=False,
+                   cpu_affinity=None, nice=None, report_dirty=False, standby_pool=0, seed_cache_size=0, stats_every=0):
         self.reward_death = reward_death
         self.stuck_duration = stuck_duration
+        self.reward_shaping = reward_shaping    # Vectorized callable f(reward, terms) -> reward (see reward.py)
+        self.pipelined = pipelined              # Game queues commands sent with step_async() before step_wait()
+        self.cpus = parse_cpus(cpu_affinity)    # Cores for fceux and the listening thread (list, '0-3' or 'auto')
+        self.nice = nice                        # Nice level of fceux
+        self.report_dirty = report_dirty        # Adds the regions of the screen changed by each step to info
+        self.seed_cache_size = int(seed_cache_size)                         # States after the no-ops kept by the env
+        self.seed_cache_home = self._get_seed_cache_home() if self.seed_cache_size > 0 else ''
+        self._evict_seed_states()
+        self.launch_vars['stats_every'] = str(int(stats_every))            # Game sends profiling counters every N frames
+
+        # Spare games launched in the background (number of spares, or a StandbyPool shared with other envs)
+        old_pool = getattr(self, 'standby_pool', None)
+        if old_pool is not None and old_pool is not standby_pool and self._owns_standby_pool:
+            old_pool.close()
+        self._owns_standby_pool = isinstance(standby_pool, int) and standby_pool > 0
+        if self._owns_standby_pool:
+            self.standby_pool = StandbyPool(standby_pool)
+        else:
+            self.standby_pool = standby_pool or None
+        if self.standby_pool is not None and 'target' in self.launch_vars:
+            self.standby_pool.register(self.launch_vars['target'], self._make_standby)
+
+    def _get_seed_cache_home(self):
+        # Returns the fceux home of the games of the env (FCEUX_HOME), which contains the slot file of the seed states
+        # The cached states are copies of the slot file, kept in the 'states' directory next to it
+        seed_cache_home = os.path.join(self.fceux_tmp_dir, 'seed-cache')
+        config_dir = os.path.join(seed_cache_home, '.fceux')
+        if not os.path.isdir(os.path.join(seed_cache_home, 'states')):
+            os.makedirs(os.path.join(seed_cache_home, 'states'))
+        if not os.path.isdir(config_dir):
+            os.makedirs(config_dir)
+            # Keeping the fceux configuration of the user
+            user_config_path = os.path.join(os.path.expanduser('~'), '.fceux', 'fceux.cfg')
+            if os.path.isfile(user_config_path):
+                shutil.copy(user_config_path, config_dir)
+        return seed_cache_home
+
+    def _get_seed_slot_path(self):
+        # Returns the path of the slot file used by the running game to exchange the seed states (or None)
+        if '' == self.fceux_home or self.seed_cache_size <= 0:
+            return None
+        rom_name = os.path.splitext(os.path.basename(self.rom_path))[0]
+        return os.path.join(self.fceux_home, '.fceux', 'fcs', '%s.fc%d' % (rom_name, SEED_SLOT - 1))
+
+    def _get_noop_option(self, seed):
+        # Returns 'load' if the state after the no-ops for (level, seed) is cached (it is copied in the slot file
+        # of the game), 'save' to ask the game to save it (see _store_seed_state), or '' without a seed cache
+        slot_path = self._get_seed_slot_path()
+        if slot_path is None or 0 == seed:
+            return ''
+        key = (self.level, seed)
+        if key in self.seed_states:
+            try:
+                shutil.copyfile(self.seed_states[key], slot_path)
+                self.seed_states.move_to_end(key)
+                self.seed_cache_hits += 1
+                return 'load'
+            except (IOError, OSError) as e:
+                logger.warn('Unable to load the seed state %s: %s' % (self.seed_states.pop(key), e))
+        self.seed_cache_misses += 1
+        self._saving_seed_key = key
+        return 'save'
+
+    def _store_seed_state(self):
+        # Called by the listening thread when the game has saved the state after the no-ops in its slot file
+        # Copies it in the seed cache, and evicts the least recently used states
+        key, self._saving_seed_key = self._saving_seed_key, None
+        slot_path = self._get_seed_slot_path()
+        if key is None or slot_path is None:
+            return
+        if not os.path.isfile(slot_path):
+            logger.warn('Unable to find the seed state saved by fceux in %s (FCEUX_HOME not supported by this fceux '
+                        'version?), disabling the seed cache' % slot_path)
+            self.seed_cache_size = 0
+            return
+        path = os.path.join(self.fceux_home, 'states', '%d-%d.fcs' % key)
+        try:
+            shutil.copyfile(slot_path, path)
+        except (IOError, OSError) as e:
+            logger.warn('Unable to copy the seed state %s: %s' % (slot_path, e))
+            return
+        self.seed_states[key] = path
+        self.seed_states.move_to_end(key)
+        self._evict_seed_states()
+
+    def _evict_seed_states(self):
+        while len(self.seed_states) > max(0, self.seed_cache_size):
+            _, path = self.seed_states.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get_seed_cache_stats(self):
+        # Returns the size of the seed cache, the number of states cached, and the number of hits and misses
+        return {
+            'size': self.seed_cache_size,
+            'states': len(self.seed_states),
+            'hits': self.seed_cache_hits,
+            'misses': self.seed_cache_misses,
+        }
 
     def _create_pipes(self):
         # Creates named pipe for inter-process communication
@@ -128,8 +270,9 @@ class NesEnv(gym.Env, utils.EzPickle):
 
         # Launching a thread that will listen to incoming pipe
         # Thread exits if self.is_exiting = 1 or pipe_in is closed
+        self.pipe_owner = [self]
         if not self.disable_in_pipe:
-            thread_incoming = Thread(target=self._listen_to_incoming_pipe, kwargs={'pipe_name': self.pipe_name})
+            thread_incoming = Thread(target=self._listen_to_incoming_pipe, kwargs={'pipe_name': self.pipe_name, 'owner': self.pipe_owner})
             thread_incoming.start()
 
             # Cannot open output pipe now, otherwise it will block until
@@ -171,8 +314,12 @@ class NesEnv(gym.Env, utils.EzPickle):
         # To be overridden by game - Processes incoming messages
         pass
 
-    def _listen_to_incoming_pipe(self, pipe_name):
+    def _listen_to_incoming_pipe(self, pipe_name, owner=None):
         # Listens to incoming messages
+        # Messages are processed by owner[0], which is changed when another env takes over the game (see _adopt_standby)
+        owner = owner or [self]
+        set_affinity(0, self.cpus)
+        self.listener_cpu_time = 0
         self.path_pipe_in = '%s-in.%s' % (self.path_pipe_prefix, pipe_name)
         if not os.path.exists(self.path_pipe_in):
             os.mkfifo(self.path_pipe_in)
@@ -181,7 +328,7 @@ class NesEnv(gym.Env, utils.EzPickle):
         except IOError:
             pipe_in = None
         buffer = ''
-        while pipe_in is not None and 0 == self.is_exiting:
+        while pipe_in is not None and 0 == owner[0].is_exiting:
             # Readline sometimes break a line in 2
             # Using ! to indicate end of message
             message = pipe_in.readline().rstrip()
@@ -189,10 +336,11 @@ class NesEnv(gym.Env, utils.EzPickle):
                 buffer += message
                 if message[-1:-2:-1] == '!':
                     try:
-                        self._process_pipe_message(buffer[:-1])
+                        owner[0]._process_pipe_message(buffer[:-1])
                     except Exception as e:
                         logger.error('Got error', e)
                         break
+                    owner[0].listener_cpu_time = thread_time()
                     if 'exit' == buffer[-5:-1]:
                         break
                     buffer = ''
@@ -207,7 +355,7 @@ class NesEnv(gym.Env, utils.EzPickle):
                 os.remove(self.path_pipe_in)
             except OSError:
                 pass
-        self.is_exiting = 0
+        owner[0].is_exiting = 0
 
     def _launch_fceux(self):
         # Making sure ROM file is valid
@@ -235,11 +383,14 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.reward = 0
         self.episode_reward = 0
         self.is_finished = False
-        self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        self._clear_screen()
         self._reset_info_vars()
 
         # Loading fceux
-        args = [FCEUX_PATH]
+        args = [self.fceux_path]
+        self.fceux_home = self.seed_cache_home
+        if self.fceux_home:
+            args.insert(0, 'FCEUX_HOME=%s' % self.fceux_home)
         args.extend(self.cmd_args[:])
         args.extend(['--loadlua', self.temp_lua_path])
         args.append(self.rom_path)
@@ -255,6 +406,8 @@ class NesEnv(gym.Env, utils.EzPickle):
                         self.pipe_out = open(self.path_pipe_out, 'w', 1)
                     except IOError:
                         self.pipe_out = None
+            if self.cpus or self.nice is not None:
+                self._place_fceux()
             # Removing lua file
             sleep(1)  # Sleeping to make sure fceux has time to load file before removing
             if os.path.isfile(self.temp_lua_path):
@@ -266,6 +419,94 @@ class NesEnv(gym.Env, utils.EzPickle):
             self.is_initialized = 0
             raise gym.error.Error('Unable to start fceux. Command: %s' % (' '.join(args)))
 
+    def _make_standby(self):
+        # Overridable - Returns a new env (not launched) that launches the same game, or None if not supported
+        return None
+
+    def _adopt_standby(self):
+        # Takes over a spare game that is ready (see StandbyPool) - Returns False if no spare is ready
+        if self.standby_pool is None:
+            return False
+        target = self.launch_vars.get('target')
+        self.standby_pool.register(target, self._make_standby)
+        spare = self.standby_pool.acquire(target)
+        if spare is None:
+            return False
+        old_owner = self.pipe_owner
+        for name in SESSION_ATTRIBUTES:
+            setattr(self, name, getattr(spare, name))
+        self.launch_vars['pipe_name'] = self.pipe_name
+        self.pipe_owner[0] = self
+        self.is_exiting = 0
+
+        # The spare no longer owns the game (closing it must not terminate fceux)
+        # Messages still sent by the previous game are sent to the spare, which stops the previous listening thread
+        spare.subprocess = None
+        spare.pipe_out = None
+        spare.path_pipe_out = ''
+        spare.pipe_owner = [spare]
+        spare.is_initialized = 0
+        spare.is_exiting = 1
+        old_owner[0] = spare
+        return True
+
+    def get_standby_stats(self):
+        # Returns the size, number of ready / launching spares, hits and misses of the standby pool (or None)
+        return self.standby_pool.stats() if self.standby_pool is not None else None
+
+    def _place_fceux(self):
+        # Pins fceux to its cores and sets its nice level (fceux is launched in the background by a shell)
+        # Right after the launch, the background child can still be the shell (skipped by find_pid), so retrying for 1 sec
+        loop_counter = 0
+        self.fceux_pid = find_pid(self.temp_lua_path)
+        while self.fceux_pid is None and loop_counter < 100:
+            loop_counter += 1
+            sleep(0.01)
+            self.fceux_pid = find_pid(self.temp_lua_path)
+        if self.fceux_pid is None:
+            logger.warn('Unable to find fceux process to set cpu affinity and nice level')
+            return
+        set_affinity(self.fceux_pid, self.cpus)
+        set_nice(self.fceux_pid, self.nice)
+
+    def get_cpu_times(self):
+        # Returns the cpu time (in seconds) used by fceux and by the listening thread since the game was launched
+        if self.fceux_pid is None and 1 == self.is_initialized:
+            self.fceux_pid = find_pid(self.temp_lua_path)
+        return {
+            'fceux': get_process_cpu_time(self.fceux_pid),
+            'listener': self.listener_cpu_time,
+            'cpus': self.cpus,
+        }
+
+    def _clear_screen(self):
+        # Resets the RGB screen, and the screen of palette indexes (as sent by the game)
+        self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        self.palette_screen = np.zeros(shape=(self.screen_height, self.screen_width), dtype=np.uint8)
+        self.dirty_rows = np.zeros(self.screen_height, dtype=bool)      # Rows and columns changed since the last frame
+        self.dirty_columns = np.zeros(self.screen_width, dtype=bool)
+        self.dirty_scroll = 0                                           # Pixels scrolled since the last frame
+
+    def _mark_dirty(self, ys, xs):
+        # Marks pixels (lists of y and x) as changed, as they are decoded
+        self.dirty_rows[ys] = True
+        self.dirty_columns[xs] = True
+
+    def _collect_dirty(self):
+        # Adds the changed regions of the frame to info, and starts a new frame
+        # dirty_bbox is (top, bottom, left, right), i.e. screen[top:bottom, left:right], or None if nothing changed
+        rows = np.flatnonzero(self.dirty_rows)
+        columns = np.flatnonzero(self.dirty_columns)
+        self.info['dirty_rows'] = self.dirty_rows.copy()
+        if len(rows) > 0 and len(columns) > 0:
+            self.info['dirty_bbox'] = (int(rows[0]), int(rows[-1]) + 1, int(columns[0]), int(columns[-1]) + 1)
+        else:
+            self.info['dirty_bbox'] = None
+        self.info['scroll'] = self.dirty_scroll
+        self.dirty_rows[:] = False
+        self.dirty_columns[:] = False
+        self.dirty_scroll = 0
+
     def _reset_info_vars(self):
         # Overridable - To reset the information variables
         self.info = {}
@@ -276,36 +517,38 @@ class NesEnv(gym.Env, utils.EzPickle):
         return
 
     def _is_dead(self):
-        # Check that the life is diminishing
-        return self.old_info.get('life', 0) > self.info.get('life', 0)
+        # Check that the life is diminishing (computed by _get_reward)
+        return self.dead
 
     def _is_stuck(self):
-        last_max_distance_update = max(
-            self.last_max_distance,
-            self.info.get('distance', 0)
-        )
-
-        if last_max_distance_update <= self.last_max_distance:
-            stuck_too_long = np.abs(self.info['time'] - self.last_max_distance_time) >= self.stuck_duration
-            return stuck_too_long
+        # Check that the max distance has not increased for stuck_duration (computed by _get_reward)
+        return self.stuck
+
+    def _get_reward(self, info=None):
+        # Runs the reward engine on the current step, and stores the updated stuck tracking state
+        # The scalar engine is used unless reward shaping is set (the shaping callable expects arrays)
+        info = self.info if info is None else info
+        kwargs = {
+            'old_distance': self.old_info.get('distance', DISTANCE_START),
+            'old_score': self.old_info.get('score', 0),
+            'old_life': self.old_info.get('life', 0),
+            'last_max_distance': self.last_max_distance,
+            'last_max_distance_time': self.last_max_distance_time,
+            'reward_death': self.reward_death,
+            'stuck_duration': self.stuck_duration,
+        }
+        if self.reward_shaping is None:
+            result = compute_reward(info['distance'], info['score'], info.get('life', 0), info['time'], **kwargs)
+            self.reward = result.reward
         else:
-            self.last_max_distance_time = self.info['time']
-            self.last_max_distance = last_max_distance_update
-            return False
-
-    def _get_reward(self):
-        distance_since_last_frame = (
-            self.info['distance'] -
-            self.old_info.get('distance', DISTANCE_START)
-        )
-        score_since_last_frame = (
-            self.info['score'] -
-            self.old_info.get('score', 0)
-        )
-        self.reward = distance_since_last_frame + score_since_last_frame - PENALTY_NOT_MOVING
-
-        if self._get_is_finished and (self._is_dead() or self._is_stuck()):
-            self.reward = self.reward_death
+            result = compute_rewards([info['distance']], [info['score']], [info.get('life', 0)], [info['time']],
+                                     shaping=self.reward_shaping, **kwargs)
+            result = result._replace(is_dead=result.is_dead[0], is_stuck=result.is_stuck[0])
+            self.reward = result.reward[0].item()
+        self.dead = bool(result.is_dead)
+        self.stuck = bool(result.is_stuck)
+        self.last_max_distance = int(result.last_max_distance)
+        self.last_max_distance_time = int(result.last_max_distance_time)
         return self.reward
 
     def _get_episode_reward(self):
@@ -325,12 +568,37 @@ class NesEnv(gym.Env, utils.EzPickle):
         return self.info
 
     def step(self, action):
+        self.step_async(action)
+        return self.step_wait()
+
+    def step_async(self, action):
+        # Sends the action to the game without waiting for the frame to be processed
+        # In pipelined mode, step_async() can be called again before step_wait(), the game queues the commands
+        if self._pending_steps and not self.pipelined:
+            raise gym.error.Error('step_async() cannot be called while a step is pending (call step_wait() first, '
+                                  'or configure(pipelined=True) to queue several steps)')
         if 0 == self.is_initialized:
-            return self._get_state(), 0, self._get_is_finished(), {}
+            self._pending_steps.append((self._get_state(), 0, self._get_is_finished(), {}))
+            return
 
         action_mapped = ACTIONS_MAPPING[action]
+        if not self._wait_until_ready():
+            self._pending_steps.append((self._get_state(), 0, True, {}))
+            return
+
+        start_frame = self.last_frame
+        self._send_noop_if_first_step(start_frame)
+        self._request_keyframe_if_needed(start_frame)
+
+        # Sending commands and resetting reward to 0
+        # In pipelined mode, the frame number is not known in advance, the game applies it to the next processed frame
+        self.reward = 0
+        command_frame = 'next' if self.pipelined else str(start_frame)
+        self._write_to_pipe('commands_%s#%s' % (command_frame, ','.join([str(i) for i in action_mapped])))
+        self._pending_steps.append(start_frame)
 
-        # Blocking until game sends ready
+    def _wait_until_ready(self):
+        # Blocking until game sends ready - Returns False if the game could not be launched
         loop_counter = 0
         restart_counter = 0
         if not self.disable_in_pipe:
@@ -346,41 +614,109 @@ class NesEnv(gym.Env, utils.EzPickle):
                     loop_counter = 0
                     if restart_counter > 5:
                         self.close()
-                        return self._get_state(), 0, True, {}
+                        return False
                     else:
                         self.reset()
                         sleep(5)
 
                 elif loop_counter % 2500 == 0 and loop_counter > 4900:
                     # Incoming pipe not opened properly, reopening
-                    thread_incoming = Thread(target=self._listen_to_incoming_pipe, kwargs={'pipe_name': self.pipe_name})
+                    thread_incoming = Thread(target=self._listen_to_incoming_pipe, kwargs={'pipe_name': self.pipe_name, 'owner': self.pipe_owner})
                     thread_incoming.start()
+        return True
 
-        start_frame = self.last_frame
+    def _request_keyframe_if_needed(self, start_frame):
+        # Asking the game to send the full screen and data on the next frame if we are out of sync
+        if self.keyframe_needed:
+            self.keyframe_needed = False
+            self.keyframe_count += 1
+            self._write_to_pipe('keyframe_%d' % start_frame)
 
+    def _send_noop_if_first_step(self, start_frame):
         # Sending no-ops if in first step
         if self.first_step:
             self.first_step = False
             self.curr_seed = seeding.hash_seed(self.curr_seed) % 256
-            self._write_to_pipe('noop_%d#%d' % (start_frame, self.curr_seed))
-
-        # Sending commands and resetting reward to 0
-        self.reward = 0
-        self._write_to_pipe('commands_%d#%s' % (start_frame, ','.join([str(i) for i in action_mapped])))
-
-        # Waiting for frame to be processed (self.last_frame will be increased when done)
-        self._wait_next_frame(start_frame)
-
-        # Getting results
-        reward = self._get_reward()
-        state = self._get_state()
-        is_finished = self._get_is_finished()
-        info = self._get_info()
+            noop_option = self._get_noop_option(self.curr_seed)
+            self._write_to_pipe('noop_%d#%d%s' % (start_frame, self.curr_seed, ':' + noop_option if noop_option else ''))
+
+    def step_wait(self):
+        # Waits for the oldest action sent with step_async() to be processed, and returns its results
+        if not self._pending_steps:
+            raise gym.error.Error('step_wait() called without a pending step_async()')
+        pending = self._pending_steps.popleft()
+        if isinstance(pending, tuple):
+            return pending
+
+        wait_start = perf_counter()
+        if self.pipelined:
+            # Results were captured when the frame was done, since the game may already be processing the next one
+            frame_result = self._wait_frame_result()
+            self.wait_time += perf_counter() - wait_start
+            if frame_result is None:
+                frame_result = (copy.deepcopy(self._get_info()), self._get_state(), self.is_finished)
+            info, state, is_finished = frame_result
+            if self.game_stuck:
+                return self._get_stuck_result(state, info)
+            reward = self._get_reward(info)
+            is_finished = is_finished or self._is_stuck()
+        else:
+            # Waiting for frame to be processed (self.last_frame will be increased when done)
+            self._wait_next_frame(pending)
+            self.wait_time += perf_counter() - wait_start
+            if self.game_stuck:
+                return self._get_stuck_result(self._get_state(), self._get_info())
+
+            # Getting results
+            reward = self._get_reward()
+            state = self._get_state()
+            is_finished = self._get_is_finished()
+            info = self._get_info()
 
         # Copy info into old info right at the end
-        self.old_info = copy.deepcopy(self.info)
+        self.old_info = copy.deepcopy(info)
         return state, reward, is_finished, info
 
+    def _get_stuck_result(self, state, info):
+        # Result of a step when the game stopped responding and was terminated - The episode is done, and
+        # info['ignore'] is set so the episode can be ignored (the info of the last frame received is kept)
+        return state, 0, True, dict(info, ignore=True)
+
+    def _on_frame_done(self, frame_number):
+        # Called by the listening thread when a frame is done processing
+        # In pipelined mode, the results are captured before the game starts sending the next frame
+        if self.report_dirty:
+            self._collect_dirty()
+        if self.pipelined:
+            self._frame_results.append((copy.deepcopy(self.info), self._get_state(), self.is_finished))
+
+    def _wait_frame_result(self):
+        # Waits for the next captured frame result (pipelined mode) - Returns None if the game is finished or stuck
+        loop_counter = 0
+        while not self._frame_results:
+            if self.is_finished or 0 == self.is_initialized or self.disable_in_pipe:
+                return None
+            loop_counter += 1
+            sleep(0.001)
+            if loop_counter >= 50000:
+                logger.warn('Closing episode (appears to be stuck). See documentation for how to handle this issue.')
+                self.game_stuck = True
+                self._kill_subprocess()
+                return None
+        return self._frame_results.popleft()
+
+    def _kill_subprocess(self):
+        if self.subprocess is not None:
+            # Workaround, killing process with pid + 1 (shell = pid, shell + 1 = fceux)
+            try:
+                cmd = "ps -ef | grep 'fceux' | grep '%s' | grep -v grep | awk '{print \"kill -9\",$2}' | sh -v" % self.temp_lua_path
+                logger.warn('kill prcess %s : %s' % (self.subprocess.pid + 1, cmd))
+                os.system(cmd + '> /dev/null')
+            except Exception as e:
+                logger.warn('Failed to kill prcess %s %s' % (self.subprocess.pid + 1, e))
+                pass
+            self.subprocess = None
+
     def _wait_next_frame(self, start_frame):
         loop_counter = 0
         if not self.disable_in_pipe:
@@ -393,17 +729,9 @@ class NesEnv(gym.Env, utils.EzPickle):
                     # Game stuck, returning
                     # Likely caused by fceux incoming pipe not working
                     logger.warn('Closing episode (appears to be stuck). See documentation for how to handle this issue.')
-                    if self.subprocess is not None:
-                        # Workaround, killing process with pid + 1 (shell = pid, shell + 1 = fceux)
-                        try:
-                            cmd = "ps -ef | grep 'fceux' | grep '%s' | grep -v grep | awk '{print \"kill -9\",$2}' | sh -v" % self.temp_lua_path
-                            logger.warn('kill prcess %s : %s' % (self.subprocess.pid + 1, cmd))
-                            os.system(cmd + '> /dev/null')
-                        except Exception as e:
-                            logger.warn('Failed to kill prcess %s %s' % (self.subprocess.pid + 1, e))
-                            pass
-                        self.subprocess = None
-                    return self._get_state(), 0, True, {'ignore': True}
+                    self.game_stuck = True
+                    self._kill_subprocess()
+                    return
 
     def reset(self):
         if 1 == self.is_initialized:
@@ -415,12 +743,21 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.first_step = True
         self.last_max_distance = 0
         self.last_max_distance_time = 0
+        self.dead = False
+        self.stuck = False
+        self.game_stuck = False
+        self._pending_steps.clear()
+        self._frame_results.clear()
         self._reset_info_vars()
-        with self.lock:
-            self._launch_fceux()
+        if self._adopt_standby():
             self._closed = False
             self._start_episode()
-        self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        else:
+            with self.lock:
+                self._launch_fceux()
+                self._closed = False
+                self._start_episode()
+        self._clear_screen()
         return self._get_state()
 
     def render(self, mode='human', close=False):
@@ -443,6 +780,19 @@ class NesEnv(gym.Env, utils.EzPickle):
                 self.viewer = rendering.SimpleImageViewer()
             self.viewer.imshow(img)
 
+    def attach_spectator(self, address=DEFAULT_ADDRESS, fps=DEFAULT_FPS, downsample=DEFAULT_DOWNSAMPLE):
+        # Publishes the screen to a viewer from a background thread (see spectator.py), without slowing down step()
+        # The tap stays attached across resets, until detach_spectator() is called
+        self.detach_spectator()
+        self.spectator = SpectatorTap(lambda: (self.last_frame, self.screen) if self.last_frame > 0 else None,
+                                      address=address, fps=fps, downsample=downsample)
+        return self.spectator
+
+    def detach_spectator(self):
+        if self.spectator is not None:
+            self.spectator.close()
+            self.spectator = None
+
     def close(self):
         # Terminating thread
         self.is_exiting = 1
@@ -458,13 +808,14 @@ class NesEnv(gym.Env, utils.EzPickle):
                 logger.warn('Failed to kill prcess %s %s' % (self.subprocess.pid + 1, str(e)))
                 pass
             self.subprocess = None
+        self.fceux_pid = None
         sleep(0.001)
         self._close_pipes()
         self.last_frame = 0
         self.reward = 0
         self.episode_reward = 0
         self.is_finished = False
-        self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        self._clear_screen()
         self._reset_info_vars()
         self.is_initialized = 0
 
@@ -686,17 +1037,21 @@ class MetaNesEnv(NesEnv):
         self.reward = 0
         self.episode_reward = 0
         self.is_finished = False
+        self.first_step = True      # Sending the no-ops (or loading the seed state) at the start of every level
+        self.game_stuck = False
+        self._pending_steps.clear()
+        self._frame_results.clear()
         self._reset_info_vars()
         if 0 == self.is_initialized:
             self._launch_fceux()
             self._closed = False
         self._start_episode()
-        self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        self._clear_screen()
         return self._get_state()
 
-    def step(self, action):
+    def step_async(self, action):
         # Changing level
         if self.find_new_level:
             self.change_level()
 
-        return NesEnv.step(self, action)
+        return NesEnv.step_async(self, action)
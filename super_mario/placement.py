@@ -0,0 +1,98 @@
+import itertools
+import os
+from threading import Lock
+
+# Placement of the emulator processes (fceux) and their listening threads on cpu cores (Linux only)
+# Cores are given as a list of cpu ids, 'auto' (next core in a round-robin over the available cores),
+# or a string such as '0-3,6'
+
+_auto_cpus = None
+_auto_cpus_lock = Lock()
+
+
+def get_available_cpus():
+    # Returns the list of cores this process is allowed to run on
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def allocate_cpus(count=1):
+    # Returns the next count cores in a round-robin over the available cores
+    global _auto_cpus
+    with _auto_cpus_lock:
+        if _auto_cpus is None:
+            _auto_cpus = itertools.cycle(get_available_cpus())
+        return [next(_auto_cpus) for _ in range(count)]
+
+
+def parse_cpus(value):
+    # Converts a cpu affinity option to a list of cpu ids (or None if no affinity is requested)
+    if value is None:
+        return None
+    if 'auto' == value:
+        return allocate_cpus()
+    if isinstance(value, int):
+        return [value]
+    if isinstance(value, str):
+        cpus = []
+        for part in value.split(','):
+            if '-' in part:
+                first, last = part.split('-')
+                cpus.extend(range(int(first), int(last) + 1))
+            elif part.strip():
+                cpus.append(int(part))
+        return cpus
+    return [int(cpu) for cpu in value]
+
+
+def set_affinity(pid, cpus):
+    # Pins a process (or the calling thread if pid is 0) to the cores - Returns False if not supported
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return False
+    try:
+        os.sched_setaffinity(pid, cpus)
+        return True
+    except OSError:
+        return False
+
+
+def set_nice(pid, nice):
+    # Sets the nice level of a process - Returns False if not supported
+    if nice is None or not hasattr(os, 'setpriority'):
+        return False
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, nice)
+        return True
+    except OSError:
+        return False
+
+
+def find_pid(pattern):
+    # Returns the pid of the first process whose command line contains pattern (using /proc)
+    if not pattern or not os.path.isdir('/proc'):
+        return None
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % name, 'rb') as cmdline_file:
+                cmdline = cmdline_file.read().replace(b'\0', b' ').decode('utf-8', 'replace')
+        except (IOError, OSError):
+            continue
+        if pattern in cmdline and 'sh -c' not in cmdline:
+            return int(name)
+    return None
+
+
+def get_process_cpu_time(pid):
+    # Returns the cpu time (user + system, in seconds) used by a process, or None if unknown
+    if pid is None:
+        return None
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as stat_file:
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return None
+    # utime and stime are fields 14 and 15 (fields[11] and fields[12] after the command name)
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
@@ -0,0 +1,144 @@
+import json
+import socket
+from threading import Lock
+
+import numpy as np
+
+import gym
+from gym import spaces
+
+from .server import (OP_SPEC, OP_RESET, OP_STEP, OP_CLOSE, OP_ERROR, COUNT,
+                     parse_address, send_frame, recv_frame, encode_indices, encode_steps)
+
+
+class RemoteEnvClient(object):
+    # Connection to a super_mario.server worker - Sends batched reset / step requests
+
+    def __init__(self, address):
+        family, connect_address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if socket.AF_INET == family:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(connect_address)
+        self.lock = Lock()
+        spec = json.loads(self._request(OP_SPEC).decode('utf-8'))
+        self.num_envs = spec['num_envs']
+        self.obs_shape = tuple(spec['obs_shape'])
+        self.obs_dtype = get_obs_dtype(spec['obs_dtype'])
+        self.num_actions = spec['num_actions']
+        self.obs_size = int(np.prod(self.obs_shape)) * self.obs_dtype.itemsize
+
+    def _request(self, opcode, payload=b''):
+        with self.lock:
+            send_frame(self.sock, opcode, payload)
+            response_opcode, response = recv_frame(self.sock)
+        if OP_ERROR == response_opcode:
+            raise gym.error.Error('Remote env error: %s' % response.decode('utf-8'))
+        return response
+
+    def _decode_states(self, payload, count):
+        offset = COUNT.size
+        states = np.frombuffer(payload, dtype=self.obs_dtype, count=count * self.obs_size // self.obs_dtype.itemsize, offset=offset)
+        return states.reshape((count,) + self.obs_shape), offset + count * self.obs_size
+
+    def reset(self, indices):
+        # Returns the observations, with shape (len(indices),) + obs_shape
+        payload = self._request(OP_RESET, encode_indices(indices))
+        count, = COUNT.unpack_from(payload)
+        states, _ = self._decode_states(payload, count)
+        return states
+
+    def step(self, indices, actions):
+        # Returns (observations, rewards, dones, infos) for the stepped envs
+        payload = self._request(OP_STEP, encode_steps(indices, actions))
+        count, = COUNT.unpack_from(payload)
+        states, offset = self._decode_states(payload, count)
+        rewards = np.frombuffer(payload, dtype=np.float32, count=count, offset=offset)
+        offset += 4 * count
+        dones = np.frombuffer(payload, dtype=np.uint8, count=count, offset=offset).astype(bool)
+        offset += count
+        infos = json.loads(payload[offset:].decode('utf-8'))
+        return states, rewards, dones, infos
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            with self.lock:
+                send_frame(self.sock, OP_CLOSE)
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+
+
+def get_obs_dtype(obs_dtype):
+    # Dtype sent in the spec - A dtype string, or the fields of a structured dtype (lists in json)
+    if isinstance(obs_dtype, list):
+        return np.dtype([tuple(field) for field in obs_dtype])
+    return np.dtype(obs_dtype)
+
+
+def get_observation_space(client):
+    # Structured observations (entity tables) cannot be described by a Box
+    if client.obs_dtype.names:
+        from .super_mario_bros import ENTITY_DTYPE, EntitySpace
+        if ENTITY_DTYPE != client.obs_dtype:
+            raise gym.error.Error('Error - Unsupported observation dtype {}'.format(client.obs_dtype))
+        return EntitySpace()
+    return spaces.Box(low=0, high=255, shape=client.obs_shape, dtype=client.obs_dtype)
+
+
+class RemoteSuperMarioBrosEnv(gym.Env):
+    # Single env hosted by a super_mario.server worker (env_index is the slot in the server pool)
+    metadata = {'render.modes': []}
+
+    def __init__(self, address, env_index=0, client=None):
+        self.client = client if client is not None else RemoteEnvClient(address)
+        self.owns_client = client is None
+        self.env_index = env_index
+        self.action_space = spaces.Discrete(self.client.num_actions)
+        self.observation_space = get_observation_space(self.client)
+
+    def reset(self):
+        return self.client.reset([self.env_index])[0]
+
+    def step(self, action):
+        states, rewards, dones, infos = self.client.step([self.env_index], [action])
+        return states[0], float(rewards[0]), bool(dones[0]), infos[0]
+
+    def render(self, mode='human', close=False):
+        return
+
+    def close(self):
+        if self.owns_client:
+            self.client.close()
+
+
+class RemoteVectorEnv(object):
+    # Batch of envs hosted by a super_mario.server worker - One round-trip per step for the whole batch
+    # Envs that are done are reset automatically, their last observation is in info['terminal_observation']
+
+    def __init__(self, address, env_indices=None):
+        self.client = RemoteEnvClient(address)
+        self.env_indices = list(range(self.client.num_envs)) if env_indices is None else list(env_indices)
+        self.num_envs = len(self.env_indices)
+        self.action_space = spaces.Discrete(self.client.num_actions)
+        self.observation_space = get_observation_space(self.client)
+
+    def reset(self):
+        return self.client.reset(self.env_indices).copy()
+
+    def step(self, actions):
+        states, rewards, dones, infos = self.client.step(self.env_indices, actions)
+        states = states.copy()
+        if dones.any():
+            done_positions = np.flatnonzero(dones)
+            new_states = self.client.reset([self.env_indices[i] for i in done_positions])
+            for i, new_state in zip(done_positions, new_states):
+                infos[i]['terminal_observation'] = states[i].copy()
+                states[i] = new_state
+        return states, rewards.copy(), dones, infos
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,104 @@
+from collections import namedtuple
+
+import numpy as np
+
+PENALTY_NOT_MOVING = 1     # Penalty when not moving
+DEFAULT_REWARD_DEATH = -2  # Negative reward when Mario dies
+DISTANCE_START = 40        # Distance at which Mario starts in the level
+STUCK_DURATION = 100       # Duration limit for Mario to get stuck in seconds
+
+# Fields read from the info dict of every step
+INFO_FIELDS = ('distance', 'score', 'life', 'time')
+
+# Results of the reward engine - Every field has the same shape as the inputs,
+# except last_max_distance and last_max_distance_time, which have the shape of the carried state
+RewardResult = namedtuple('RewardResult', ['reward', 'is_dead', 'is_stuck', 'last_max_distance', 'last_max_distance_time'])
+
+
+def compute_rewards(distance, score, life, time,
+                    old_distance=DISTANCE_START, old_score=0, old_life=0,
+                    last_max_distance=0, last_max_distance_time=0,
+                    reward_death=DEFAULT_REWARD_DEATH, stuck_duration=STUCK_DURATION, shaping=None):
+    # Computes the reward, death and stuck flags for N envs over T steps
+    # - distance, score, life and time are arrays of shape (T,) or (N, T) (the last axis is time)
+    # - old_* are the values before the first step (i.e. old_info), with shape () or (N,)
+    # - last_max_distance and last_max_distance_time are the stuck tracking state carried in, with shape () or (N,)
+    # - shaping is an optional callable f(reward, terms) -> reward applied once on the whole array, where
+    #   terms is a dict of arrays (distance_delta, score_delta, is_dead, is_stuck, distance, score, life, time)
+    # This function is pure, the updated stuck tracking state is returned instead of being stored
+    distance = np.asarray(distance, dtype=np.int64)
+    score = np.asarray(score, dtype=np.int64)
+    life = np.asarray(life, dtype=np.int64)
+    time = np.asarray(time, dtype=np.int64)
+    batch_shape = distance.shape[:-1]
+    num_steps = distance.shape[-1]
+
+    def _previous(values, initial):
+        # Shifts values by one step on the time axis, using initial for the first step
+        initial = np.broadcast_to(np.asarray(initial, dtype=np.int64), batch_shape)
+        return np.concatenate([initial[..., None], values[..., :-1]], axis=-1)
+
+    distance_delta = distance - _previous(distance, old_distance)
+    score_delta = score - _previous(score, old_score)
+    is_dead = _previous(life, old_life) > life
+
+    # Stuck tracking - Mario is stuck if the max distance has not increased for stuck_duration
+    # running_max[..., t] is the max distance reached before step t
+    initial_max = np.broadcast_to(np.asarray(last_max_distance, dtype=np.int64), batch_shape)
+    initial_time = np.broadcast_to(np.asarray(last_max_distance_time, dtype=np.int64), batch_shape)
+    running_max = np.maximum.accumulate(np.concatenate([initial_max[..., None], distance], axis=-1), axis=-1)
+    is_updated = distance > running_max[..., :-1]
+
+    # Time at which the max distance was last updated (or carried in time if never updated)
+    update_index = np.where(is_updated, np.arange(num_steps), -1)
+    update_index = np.maximum.accumulate(update_index, axis=-1)
+    update_time = np.take_along_axis(time, np.maximum(update_index, 0), axis=-1)
+    update_time = np.where(update_index >= 0, update_time, initial_time[..., None])
+    is_stuck = ~is_updated & (np.abs(time - update_time) >= stuck_duration)
+
+    reward = distance_delta + score_delta - PENALTY_NOT_MOVING
+    reward = np.where(is_dead | is_stuck, reward_death, reward)
+    if shaping is not None:
+        terms = {
+            'distance_delta': distance_delta,
+            'score_delta': score_delta,
+            'is_dead': is_dead,
+            'is_stuck': is_stuck,
+            'distance': distance,
+            'score': score,
+            'life': life,
+            'time': time,
+        }
+        reward = shaping(reward, terms)
+
+    return RewardResult(reward, is_dead, is_stuck, running_max[..., -1], update_time[..., -1])
+
+
+def compute_reward(distance, score, life, time,
+                   old_distance=DISTANCE_START, old_score=0, old_life=0,
+                   last_max_distance=0, last_max_distance_time=0,
+                   reward_death=DEFAULT_REWARD_DEATH, stuck_duration=STUCK_DURATION):
+    # Scalar version of compute_rewards() for a single step of a single env (no numpy overhead)
+    # Returns a RewardResult of python scalars (reward shaping is only applied by compute_rewards)
+    is_dead = old_life > life
+    is_updated = distance > last_max_distance
+    if is_updated:
+        last_max_distance, last_max_distance_time = distance, time
+    is_stuck = not is_updated and abs(time - last_max_distance_time) >= stuck_duration
+    if is_dead or is_stuck:
+        reward = reward_death
+    else:
+        reward = (distance - old_distance) + (score - old_score) - PENALTY_NOT_MOVING
+    return RewardResult(reward, is_dead, is_stuck, last_max_distance, last_max_distance_time)
+
+
+def infos_to_arrays(infos, fields=INFO_FIELDS):
+    # Converts a recorded stream of info dicts (one per step) to a dict of arrays of shape (T,)
+    # Missing values are reported as -1 (i.e. unknown), like in the info dict
+    return {name: np.array([info.get(name, -1) for info in infos], dtype=np.int64) for name in fields}
+
+
+def compute_rewards_from_infos(infos, **kwargs):
+    # Recomputes the rewards of a recorded episode from its stream of info dicts
+    arrays = infos_to_arrays(infos)
+    return compute_rewards(arrays['distance'], arrays['score'], arrays['life'], arrays['time'], **kwargs)
@@ -0,0 +1,237 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy as np
+
+import gym
+
+logger = logging.getLogger(__name__)
+
+# ===========================
+#         Protocol
+# ===========================
+# Every message is a frame: <length (uint32)><opcode (uint8)><payload (length bytes)>
+# - spec      request: empty
+#             response: json {num_envs, obs_shape, obs_dtype, num_actions}
+#             (obs_dtype is a numpy dtype string, or the list of fields of a structured dtype, e.g. the Entities envs)
+# - reset     request: <count (uint16)><env index (uint16)> * count
+#             response: <count (uint16)><observations (count * obs bytes)>
+# - step      request: <count (uint16)>(<env index (uint16)><action (uint8)>) * count
+#             response: <count (uint16)><observations><rewards (float32 * count)><dones (uint8 * count)><json infos>
+# - close     request: empty (server closes the connection)
+# - error     response: utf-8 error message
+OP_SPEC = 1
+OP_RESET = 2
+OP_STEP = 3
+OP_CLOSE = 4
+OP_ERROR = 255
+
+HEADER = struct.Struct('!IB')
+COUNT = struct.Struct('!H')
+INDEX_DTYPE = np.dtype('>u2')
+STEP_DTYPE = np.dtype([('index', '>u2'), ('action', 'u1')])
+
+
+def parse_address(address):
+    # Returns (socket family, address) - Format: 'unix:/path/to/socket' or 'host:port'
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def recv_exactly(sock, length):
+    # Reads exactly length bytes from the socket
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:], length - received)
+        if 0 == count:
+            raise EOFError('Connection closed')
+        received += count
+    return bytes(buffer)
+
+
+def send_frame(sock, opcode, payload=b''):
+    sock.sendall(HEADER.pack(len(payload), opcode) + payload)
+
+
+def recv_frame(sock):
+    # Returns (opcode, payload)
+    length, opcode = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return opcode, recv_exactly(sock, length)
+
+
+def encode_indices(indices):
+    return COUNT.pack(len(indices)) + np.asarray(indices, dtype=INDEX_DTYPE).tobytes()
+
+
+def decode_indices(payload):
+    count, = COUNT.unpack_from(payload)
+    return np.frombuffer(payload, dtype=INDEX_DTYPE, count=count, offset=COUNT.size).tolist()
+
+
+def encode_steps(indices, actions):
+    steps = np.empty(len(indices), dtype=STEP_DTYPE)
+    steps['index'] = indices
+    steps['action'] = actions
+    return COUNT.pack(len(indices)) + steps.tobytes()
+
+
+def decode_steps(payload):
+    count, = COUNT.unpack_from(payload)
+    steps = np.frombuffer(payload, dtype=STEP_DTYPE, count=count, offset=COUNT.size)
+    return steps['index'].tolist(), steps['action'].tolist()
+
+
+# ===========================
+#         Server
+# ===========================
+class EnvPool(object):
+    # Hosts a pool of envs, and steps them in parallel threads (step() mostly sleeps while fceux emulates)
+    # As in vector_env, the envs are used without the gym.make wrappers (their API depends on the gym version),
+    # and the time limit of the env spec is applied by the pool (info['TimeLimit.truncated'] is set)
+
+    def __init__(self, env_id, num_envs, configure=None):
+        self.envs = []
+        self.max_steps = None
+        for _ in range(num_envs):
+            env = gym.make(env_id)
+            self.max_steps = getattr(env.spec, 'max_episode_steps', None)
+            env = env.unwrapped
+            if configure:
+                env.configure(**configure)
+            self.envs.append(env)
+        self.step_counts = [0] * num_envs
+        self.locks = [Lock() for _ in range(num_envs)]
+        self.executor = ThreadPoolExecutor(max_workers=num_envs)
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self.obs_dtype = np.dtype(getattr(self.observation_space, 'dtype', np.uint8))
+
+    def spec(self):
+        return {
+            'num_envs': len(self.envs),
+            'obs_shape': list(self.observation_space.shape),
+            'obs_dtype': self.obs_dtype.descr if self.obs_dtype.names else self.obs_dtype.str,
+            'num_actions': int(self.action_space.n),
+        }
+
+    def _reset_one(self, index):
+        with self.locks[index]:
+            self.step_counts[index] = 0
+            return self.envs[index].reset()
+
+    def _step_one(self, index, action):
+        with self.locks[index]:
+            state, reward, is_finished, info = self.envs[index].step(action)
+            self.step_counts[index] += 1
+            if not is_finished and self.max_steps is not None and self.step_counts[index] >= self.max_steps:
+                is_finished = True
+                info = dict(info, **{'TimeLimit.truncated': True})
+            return state, reward, is_finished, info
+
+    def reset(self, indices):
+        return list(self.executor.map(self._reset_one, indices))
+
+    def step(self, indices, actions):
+        return list(self.executor.map(self._step_one, indices, actions))
+
+    def close(self):
+        self.executor.shutdown()
+        for env in self.envs:
+            env.close()
+
+
+class EnvRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        pool = self.server.pool
+        while True:
+            try:
+                opcode, payload = recv_frame(self.request)
+            except (EOFError, ConnectionError):
+                return
+            try:
+                if OP_SPEC == opcode:
+                    send_frame(self.request, OP_SPEC, json.dumps(pool.spec()).encode('utf-8'))
+                elif OP_RESET == opcode:
+                    indices = decode_indices(payload)
+                    states = pool.reset(indices)
+                    send_frame(self.request, OP_RESET, COUNT.pack(len(indices)) + self._encode_states(pool, states))
+                elif OP_STEP == opcode:
+                    indices, actions = decode_steps(payload)
+                    results = pool.step(indices, actions)
+                    states, rewards, dones, infos = zip(*results) if results else ((), (), (), ())
+                    send_frame(self.request, OP_STEP, b''.join([
+                        COUNT.pack(len(indices)),
+                        self._encode_states(pool, states),
+                        np.asarray(rewards, dtype=np.float32).tobytes(),
+                        np.asarray(dones, dtype=np.uint8).tobytes(),
+                        json.dumps(infos, default=str).encode('utf-8'),
+                    ]))
+                elif OP_CLOSE == opcode:
+                    return
+                else:
+                    send_frame(self.request, OP_ERROR, ('Unknown opcode %d' % opcode).encode('utf-8'))
+            except Exception as e:
+                logger.error('Error while processing opcode %d: %s' % (opcode, e))
+                send_frame(self.request, OP_ERROR, str(e).encode('utf-8'))
+
+    def _encode_states(self, pool, states):
+        return b''.join(np.ascontiguousarray(state, dtype=pool.obs_dtype).tobytes() for state in states)
+
+
+class ThreadingTCPEnvServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class ThreadingUnixEnvServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def make_server(address, pool):
+    # Returns a server (not started) serving the pool on a TCP ('host:port') or Unix ('unix:/path') address
+    family, bind_address = parse_address(address)
+    if socket.AF_UNIX == family:
+        if os.path.exists(bind_address):
+            os.remove(bind_address)
+        server = ThreadingUnixEnvServer(bind_address, EnvRequestHandler)
+    else:
+        server = ThreadingTCPEnvServer(bind_address, EnvRequestHandler)
+    server.pool = pool
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves a pool of Super Mario Bros envs over a socket')
+    parser.add_argument('--address', default='127.0.0.1:5555', help="'host:port' or 'unix:/path/to/socket'")
+    parser.add_argument('--env', default='SuperMarioBros-1-1-v2', help='gym env id')
+    parser.add_argument('--num-envs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--configure', default='{}', help='json kwargs passed to env.configure()')
+    args = parser.parse_args(argv)
+
+    pool = EnvPool(args.env, args.num_envs, configure=json.loads(args.configure))
+    server = make_server(args.address, pool)
+    logger.warning('Serving %d x %s on %s' % (args.num_envs, args.env, args.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
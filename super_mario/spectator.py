@@ -0,0 +1,136 @@
+import argparse
+import errno
+import logging
+import os
+import socket
+import struct
+import tempfile
+from threading import Thread, Event
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Spectator stream - Watching one env of a fleet without slowing it down
+# A SpectatorTap runs in a background thread, reads the screen of its env at most 'fps' times per second,
+# downsamples it and sends it as one datagram on a non-blocking Unix socket
+# The env never waits for the spectator: frames are dropped when no viewer is listening or when the viewer lags
+#
+#   env.attach_spectator()                          # or vec_env.attach_spectator(3)
+#   python -m super_mario.spectator                 # viewer (binds the socket and shows the frames)
+
+DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), 'smb-spectator.sock')
+DEFAULT_FPS = 15
+DEFAULT_DOWNSAMPLE = 2
+
+# Datagram: header (frame number, height, width, channels) + uint8 pixels (row-major)
+HEADER = struct.Struct('<IHHB')
+MAX_DATAGRAM_SIZE = 256 * 1024
+
+
+class SpectatorTap(object):
+    # Publishes the frames returned by source() -> (frame_number, image) or None, from a background thread
+    # A frame is only sent if its frame number changed since the last frame sent
+
+    def __init__(self, source, address=DEFAULT_ADDRESS, fps=DEFAULT_FPS, downsample=DEFAULT_DOWNSAMPLE):
+        self.source = source
+        self.address = address
+        self.interval = 1. / fps
+        self.downsample = max(1, int(downsample))
+        self.sent = 0               # Number of frames sent
+        self.dropped = 0            # Number of frames dropped (no viewer, or viewer lagging)
+        self.last_frame = None
+        self.stopped = Event()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.thread = Thread(target=self._run, name='spectator-tap')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _get_frame(self):
+        # Returns the datagram of the current frame, or None if there is no new frame
+        result = self.source()
+        if result is None:
+            return None
+        frame_number, image = result
+        if frame_number == self.last_frame or image is None:
+            return None
+        self.last_frame = frame_number
+        image = image[::self.downsample, ::self.downsample]
+        if 2 == image.ndim:
+            image = image[:, :, None]
+        if np.uint8 != image.dtype:
+            image = np.clip(image, 0, 255).astype(np.uint8)
+        height, width, channels = image.shape
+        return HEADER.pack(int(frame_number) % 2 ** 32, height, width, channels) + np.ascontiguousarray(image).tobytes()
+
+    def _run(self):
+        # Background thread - Sends at most one frame every interval
+        while not self.stopped.wait(self.interval):
+            try:
+                datagram = self._get_frame()
+            except Exception as e:
+                logger.warning('Spectator tap stopped, unable to read the frame: %s' % e)
+                return
+            if datagram is None:
+                continue
+            try:
+                self.sock.sendto(datagram, self.address)
+                self.sent += 1
+            except (BlockingIOError, ConnectionRefusedError, FileNotFoundError):
+                # Viewer lagging or not listening, dropping the frame
+                self.dropped += 1
+            except OSError as e:
+                if errno.EMSGSIZE != e.errno:
+                    raise
+                logger.warning('Spectator frame too large (%d bytes), increase downsample' % len(datagram))
+                self.dropped += 1
+
+    def stats(self):
+        return {'sent': self.sent, 'dropped': self.dropped}
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(timeout=1)
+        self.sock.close()
+
+
+def receive_frames(address=DEFAULT_ADDRESS):
+    # Generator - Binds address and yields (frame_number, image) for every frame received
+    if os.path.exists(address):
+        os.unlink(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(address)
+    try:
+        while True:
+            datagram = sock.recv(MAX_DATAGRAM_SIZE)
+            frame_number, height, width, channels = HEADER.unpack_from(datagram)
+            image = np.frombuffer(datagram, dtype=np.uint8, offset=HEADER.size).reshape((height, width, channels))
+            yield frame_number, image
+    finally:
+        sock.close()
+        if os.path.exists(address):
+            os.unlink(address)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shows the frames published by a spectator tap')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='path of the Unix socket')
+    parser.add_argument('--zoom', type=int, default=DEFAULT_DOWNSAMPLE, help='upscales the frames by this factor')
+    args = parser.parse_args(argv)
+
+    from gym.envs.classic_control import rendering
+    viewer = rendering.SimpleImageViewer()
+    try:
+        for _, image in receive_frames(args.address):
+            if 1 == image.shape[2]:
+                image = np.repeat(image, 3, axis=2)
+            if args.zoom > 1:
+                image = np.repeat(np.repeat(image, args.zoom, axis=0), args.zoom, axis=1)
+            viewer.imshow(image)
+    finally:
+        viewer.close()
+
+
+if __name__ == '__main__':
+    main()
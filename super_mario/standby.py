@@ -0,0 +1,105 @@
+import atexit
+import logging
+from collections import deque
+from threading import Thread, Condition
+
+logger = logging.getLogger(__name__)
+
+
+class StandbyPool(object):
+    # Keeps 'size' spare games per target launched in the background, and parked at the start of the level
+    # reset() takes over a ready spare instead of launching fceux (see NesEnv._adopt_standby), and the pool
+    # launches a replacement in the background
+    # A pool can be shared by several envs (e.g. env.configure(standby_pool=pool)), spares are keyed by target
+
+    def __init__(self, size=1):
+        self.size = size
+        self.spares = {}            # Spare envs by target, oldest first
+        self.factories = {}         # Function returning a new (not launched) env, by target
+        self.hits = 0               # Number of resets that took over a ready spare
+        self.misses = 0             # Number of resets that had to launch fceux
+        self.is_closed = False
+        self.condition = Condition()
+        self.thread = Thread(target=self._refill, name='standby-pool')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def register(self, target, factory):
+        # Starts keeping spares for target (factory is only registered once per target)
+        with self.condition:
+            if target not in self.factories:
+                self.factories[target] = factory
+                self.spares[target] = deque()
+                self.condition.notify()
+
+    def acquire(self, target):
+        # Returns a spare that is ready (its game has sent ready), or None
+        with self.condition:
+            spares = self.spares.get(target, ())
+            for spare in spares:
+                if spare.last_frame > 0:
+                    spares.remove(spare)
+                    self.hits += 1
+                    self.condition.notify()
+                    return spare
+            self.misses += 1
+            return None
+
+    def stats(self):
+        with self.condition:
+            return {
+                'size': self.size,
+                'ready': sum(1 for spares in self.spares.values() for spare in spares if spare.last_frame > 0),
+                'launching': sum(1 for spares in self.spares.values() for spare in spares if 0 == spare.last_frame),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _get_target_to_refill(self):
+        for target, spares in self.spares.items():
+            if len(spares) < self.size:
+                return target
+        return None
+
+    def _refill(self):
+        # Background thread - Launches spares until every target has 'size' spares
+        while True:
+            with self.condition:
+                target = self._get_target_to_refill()
+                while not self.is_closed and target is None:
+                    self.condition.wait()
+                    target = self._get_target_to_refill()
+                if self.is_closed:
+                    return
+                factory = self.factories[target]
+            try:
+                spare = factory()
+                if spare is None:
+                    # Target does not support spares
+                    with self.condition:
+                        self.spares.pop(target, None)
+                    continue
+                spare.reset()
+            except Exception as e:
+                logger.warning('Unable to launch a standby game for target %s: %s' % (target, e))
+                with self.condition:
+                    self.condition.wait(5)
+                continue
+            with self.condition:
+                if self.is_closed:
+                    spare.close()
+                    return
+                self.spares[target].append(spare)
+
+    def close(self):
+        # Closes the spares (the games they launched are terminated)
+        with self.condition:
+            if self.is_closed:
+                return
+            self.is_closed = True
+            spares = [spare for target_spares in self.spares.values() for spare in target_spares]
+            self.spares = {}
+            self.condition.notify_all()
+        for spare in spares:
+            spare.close()
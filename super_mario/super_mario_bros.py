@@ -1,28 +1,32 @@
+import copy
 import logging
 import os
+import zlib
+from threading import get_ident
+from time import sleep, thread_time, perf_counter
 
 import numpy as np
 
+import gym
 from gym import spaces
+from .levels import SMB_LEVELS, WORLD_NUMBER, LEVEL_NUMBER, AREA_NUMBER, MAX_DISTANCE, get_standard_reward  # noqa: F401 (re-exported)
 from .nes_env import NesEnv, MetaNesEnv
+from .reward import DISTANCE_START, compute_rewards
 
 logger = logging.getLogger(__name__)
 
-# (world_number, level_number, area_number, max_distance)
-WORLD_NUMBER = 0
-LEVEL_NUMBER = 1
-AREA_NUMBER = 2
-MAX_DISTANCE = 3
-SMB_LEVELS = [
-    (1, 1, 1, 3266), (1, 2, 2, 3266), (1, 3, 4, 2514), (1, 4, 5, 2430),
-    (2, 1, 1, 3298), (2, 2, 2, 3266), (2, 3, 4, 3682), (2, 4, 5, 2430),
-    (3, 1, 1, 3298), (3, 2, 2, 3442), (3, 3, 3, 2498), (3, 4, 4, 2430),
-    (4, 1, 1, 3698), (4, 2, 2, 3266), (4, 3, 4, 2434), (4, 4, 5, 2942),
-    (5, 1, 1, 3282), (5, 2, 2, 3298), (5, 3, 3, 2514), (5, 4, 4, 2429),
-    (6, 1, 1, 3106), (6, 2, 2, 3554), (6, 3, 3, 2754), (6, 4, 4, 2429),
-    (7, 1, 1, 2962), (7, 2, 2, 3266), (7, 3, 4, 3682), (7, 4, 5, 3453),
-    (8, 1, 1, 6114), (8, 2, 2, 3554), (8, 3, 3, 3554), (8, 4, 4, 4989)]
 SUPER_MARIO_ROM_PATH = os.path.join(os.path.dirname(__file__), 'roms', 'super-mario.nes')
+SEQUENCE_FIELDS = ['distance', 'life', 'score', 'coins', 'time', 'player_status', 'is_finished']
+TILE_PALETTES = { 0: '0D', 1: '30', 2: '27', 3: '05' }   # Palette used to draw each tile value on the screen
+SCROLL_SPLIT_ROW = 24       # Screen rows above this row are the status bar, which does not scroll (see scroll_split_row)
+OBS_MODES = ['screen', 'entities']
+
+# Entity observation (obs_mode='entities') - One record per entity, in a fixed order (see get_entities in the lua file)
+# kind: 1 - Mario, 2 - Enemy, 3 - Powerup, 4 - Fireball / type: player status for Mario, enemy or powerup type
+# x: position in the level (same unit as distance) / y: position on the screen / vx, vy: speed / active: 0 or 1
+ENTITY_DTYPE = np.dtype([('kind', 'u1'), ('type', 'u1'), ('x', '<u2'), ('y', 'u1'), ('vx', 'i1'), ('vy', 'i1'), ('active', 'u1')])
+ENTITY_KINDS = [1, 2, 2, 2, 2, 2, 3, 4, 4]
+NUM_ENTITIES = len(ENTITY_KINDS)
 
 # --------------
 # Helper Methods
@@ -38,19 +42,54 @@ def is_int16(str):
 # --------------
 # Classes
 # --------------
+class EntitySpace(spaces.Space):
+    # Space of the entity observations (structured array of NUM_ENTITIES records of ENTITY_DTYPE)
+    def __init__(self):
+        spaces.Space.__init__(self, shape=(NUM_ENTITIES,), dtype=ENTITY_DTYPE)
+
+    def sample(self):
+        entities = np.frombuffer(np.random.bytes(NUM_ENTITIES * ENTITY_DTYPE.itemsize), dtype=ENTITY_DTYPE).copy()
+        entities['kind'] = ENTITY_KINDS
+        entities['active'] &= 1
+        return entities
+
+    def contains(self, x):
+        return isinstance(x, np.ndarray) and ENTITY_DTYPE == x.dtype and self.shape == x.shape
+
+    def __repr__(self):
+        return 'EntitySpace({})'.format(NUM_ENTITIES)
+
+
 class SuperMarioBrosEnv(NesEnv):
-    def __init__(self, draw_tiles=False, level=0):
+    def __init__(self, draw_tiles=False, level=0, obs_mode='screen'):
         NesEnv.__init__(self)
+        if obs_mode not in OBS_MODES:
+            raise gym.error.Error('Error - The obs_mode "{}" is not valid. Expected one of {}'.format(obs_mode, OBS_MODES))
+        if draw_tiles and 'screen' != obs_mode:
+            raise gym.error.Error('Error - obs_mode "{}" cannot be used with draw_tiles'.format(obs_mode))
         package_directory = os.path.dirname(os.path.abspath(__file__))
         self.level = level
         self.draw_tiles = 1 if draw_tiles else 0
+        self.obs_mode = obs_mode
         self._mode = 'algo'             # 'algo' or 'human'
         self.lua_path.append(os.path.join(package_directory, 'lua/super-mario-bros.lua'))
         self.tiles = None
+        self.entities = None                # Entity table (obs_mode='entities')
+        self.sequence_records = None        # Per-step data of the last action sequence (see step_sequence)
+        self.sequence_observations = []     # Intermediate observations of the last action sequence
+        self.saved_states = {}              # Python side of the states saved in memory by the game (see clone_state)
+        self.last_state_handle = 0
+        self.restored_frame = None          # Frame number (and handle) sent by the game after restoring a state
+        self.restored_handle = None
+        self.emulator_stats = {}            # Last profiling counters sent by the game (see configure(stats_every=N))
+        self._last_stats = None             # (time, listener cpu time, wait time, thread) when the last counters were received
+        self._stats_frame = None            # Frame of the last counters (only reported in the info of that step)
         self.launch_vars['target'] = self._get_level_code(self.level)
         self.launch_vars['mode'] = 'algo'
         self.launch_vars['meta'] = '0'
         self.launch_vars['draw_tiles'] = str(self.draw_tiles)
+        self.launch_vars['obs_mode'] = obs_mode
+        self.launch_vars['overlay'] = '0'
         if os.path.isfile(SUPER_MARIO_ROM_PATH):
             self.rom_path = SUPER_MARIO_ROM_PATH
 
@@ -63,6 +102,12 @@ class SuperMarioBrosEnv(NesEnv):
             self.tiles = np.zeros(shape=(self.tile_height, self.tile_width), dtype=np.uint8)
             self.observation_space = spaces.Box(low=0, high=3, shape=(self.tile_height, self.tile_width))
 
+        # Entities mode (the game does not send the screen)
+        if 'entities' == self.obs_mode:
+            self.entities = np.zeros(NUM_ENTITIES, dtype=ENTITY_DTYPE)
+            self._clear_entities()
+            self.observation_space = EntitySpace()
+
     # --------------
     # Properties
     # --------------
@@ -82,6 +127,15 @@ class SuperMarioBrosEnv(NesEnv):
             self.disable_out_pipe = False
             self.disable_in_pipe = False
 
+    @property
+    def overlay(self):
+        # Draws the distance and the tiles on the fceux window (always drawn in human mode)
+        return '1' == self.launch_vars['overlay']
+
+    @overlay.setter
+    def overlay(self, value):
+        self.launch_vars['overlay'] = '1' if value else '0'
+
     # --------------
     # Methods
     # --------------
@@ -114,12 +168,47 @@ class SuperMarioBrosEnv(NesEnv):
         # Format: screen_<frame>#<x (2 hex)><y (2 hex)><palette (2 hex)>|<x><y><p>|...
         if frame_number <= self.last_frame or self.screen is None:
             return
+        ys, xs = [], []
         parts = data.split('|')
         for part in parts:
             if 6 == len(part) and is_int16(part[0:2]) and is_int16(part[2:4]):
+                if not is_int16(part[4:6]):
+                    # Garbled palette, the pixel is left as is and repaired by the next keyframe
+                    self.keyframe_needed = True
+                    continue
                 x = int(part[0:2], 16)
                 y = int(part[2:4], 16)
                 self.screen[y][x] = self._get_rgb_from_palette(part[4:6])
+                self.palette_screen[y][x] = int(part[4:6], 16)
+                ys.append(y)
+                xs.append(x)
+        if self.report_dirty:
+            self._mark_dirty(ys, xs)
+
+    def _process_scroll_message(self, frame_number, data):
+        # The screen scrolled dx pixels to the right, sent before the screen diffs (which only contain the exposed
+        # columns and the moving sprites). The status bar rows are not shifted.
+        # Format: scroll_<frame>#<dx>
+        if frame_number <= self.last_frame or self.screen is None or not data.isdigit():
+            return
+        dx = int(data)
+        if 0 < dx < self.screen_width:
+            for screen in (self.screen, self.palette_screen):
+                screen[SCROLL_SPLIT_ROW:, :-dx] = screen[SCROLL_SPLIT_ROW:, dx:]
+                screen[SCROLL_SPLIT_ROW:, -dx:] = 0
+            if self.report_dirty:
+                self.dirty_rows[SCROLL_SPLIT_ROW:] = True
+                self.dirty_columns[:] = True
+                self.dirty_scroll += dx
+
+    def _process_checksum_message(self, frame_number, data):
+        # Checksum of the screen (adler-32 of the palette indexes, row by row), sent after the screen diffs
+        # A mismatch means a diff was lost, a keyframe will be requested with the next command
+        # Format: checksum_<frame>#<checksum>
+        if frame_number <= self.last_frame or not data.isdigit():
+            return
+        if int(data) != zlib.adler32(self.palette_screen.tobytes()) & 0xffffffff:
+            self.keyframe_needed = True
 
     def _process_tiles_message(self, frame_number, data):
         # Format: tiles_<frame>#<x (1 hex)><y (1 hex)><value (1 hex)>|<x><y><v>|...
@@ -132,10 +221,76 @@ class SuperMarioBrosEnv(NesEnv):
                 y = int(part[1:2], 16)
                 v = int(part[2:3], 16)
                 self.tiles[y][x] = v
-                if v == 0: self.screen[y][x] = self._get_rgb_from_palette('0D')
-                if v == 1: self.screen[y][x] = self._get_rgb_from_palette('30')
-                if v == 2: self.screen[y][x] = self._get_rgb_from_palette('27')
-                if v == 3: self.screen[y][x] = self._get_rgb_from_palette('05')
+                if v in TILE_PALETTES:
+                    self.screen[y][x] = self._get_rgb_from_palette(TILE_PALETTES[v])
+                    self.palette_screen[y][x] = int(TILE_PALETTES[v], 16)
+                if self.report_dirty:
+                    self._mark_dirty(y, x)
+
+    def _process_entities_message(self, frame_number, data):
+        # Fixed records of ENTITY_DTYPE (8 bytes per entity), hex-encoded
+        # Format: entities_<frame>#<16 hex digits per entity>
+        if frame_number <= self.last_frame or self.entities is None:
+            return
+        if len(data) != 2 * NUM_ENTITIES * ENTITY_DTYPE.itemsize or not is_int16(data):
+            return
+        self.entities[:] = np.frombuffer(bytes.fromhex(data), dtype=ENTITY_DTYPE)
+
+    def _clear_entities(self):
+        self.entities[:] = 0
+        self.entities['kind'] = ENTITY_KINDS
+
+    def _process_seq_message(self, frame_number, data):
+        # Format: seq_<frame>#<distance>,<life>,<score>,<coins>,<time>,<player_status>,<is_finished>|...  (one record per step)
+        if frame_number <= self.last_frame:
+            return
+        self.sequence_records = [[int(value) for value in record.split(',')] for record in data.split('|') if record]
+
+    def _process_obs_message(self, frame_number):
+        # Intermediate observation of an action sequence (screen and tiles of this frame have been received)
+        # Format: obs_<frame>
+        if frame_number <= self.last_frame:
+            return
+        self.sequence_observations.append(self._get_state())
+
+    def _process_restored_message(self, frame_number, data):
+        # Sent after a state is restored, the frame number can be lower than the last frame
+        # Format: restored_<frame>#<handle> (handle is -1 if the state could not be found)
+        self.restored_handle = data
+        self.restored_frame = frame_number
+
+    def _process_stats_message(self, frame_number, data):
+        # Profiling counters of the game since the last stats message (cpu times in ms), with the python side
+        # times over the same period: wall (elapsed), python_decode (listening thread cpu), python_wait (in step_wait)
+        # Format: stats_<frame>#name_1:value_1|name_2:value_2|...
+        stats = {}
+        for part in data.split('|'):
+            name, _, value = part.partition(':')
+            if not name or not value:
+                continue
+            try:
+                stats[name] = int(value) if value.isdigit() else float(value)
+            except ValueError:
+                continue
+        now = (perf_counter(), thread_time(), self.wait_time, get_ident())
+        if self._last_stats is not None and self._last_stats[3] == now[3]:     # Same game (and listening thread)
+            stats['wall'] = 1000 * (now[0] - self._last_stats[0])
+            stats['python_decode'] = 1000 * (now[1] - self._last_stats[1])
+            stats['python_wait'] = 1000 * (now[2] - self._last_stats[2])
+        self._last_stats = now
+        self._stats_frame = frame_number
+        self.emulator_stats = stats
+        if self.info is not None:
+            self.info['emulator_stats'] = stats
+
+    def get_emulator_stats(self):
+        # Returns the last profiling counters (empty if configure(stats_every=N) was not set before reset())
+        return dict(self.emulator_stats)
+
+    def _process_seedsaved_message(self):
+        # The game saved the state after the no-ops in the seed slot (see NesEnv._get_noop_option)
+        # Format: seedsaved_<frame>#<noop count>
+        self._store_seed_state()
 
     def _process_ready_message(self, frame_number):
         # Format: ready_<frame>
@@ -146,6 +301,10 @@ class SuperMarioBrosEnv(NesEnv):
         # Done means frame is done processing, please send next command
         # Format: done_<frame>
         if frame_number > self.last_frame:
+            if self.info is not None and frame_number != self._stats_frame:
+                # Counters are sent before done, and are only reported in the info of the step that received them
+                self.info.pop('emulator_stats', None)
+            self._on_frame_done(frame_number)
             self.last_frame = frame_number
 
     def _process_reset_message(self):
@@ -193,8 +352,9 @@ class SuperMarioBrosEnv(NesEnv):
         message_type = parts[0] if len(parts) > 0 else ''
         frame_number = self._parse_frame_number(parts)
 
-        # Invalid message - Ignoring
+        # Invalid message - Ignoring, and requesting a keyframe since a diff might have been lost
         if frame_number is None:
+            self.keyframe_needed = True
             return
 
         # Processing
@@ -202,8 +362,24 @@ class SuperMarioBrosEnv(NesEnv):
             self._process_data_message(frame_number, data)
         elif 'screen' == message_type:
             self._process_screen_message(frame_number, data)
+        elif 'scroll' == message_type:
+            self._process_scroll_message(frame_number, data)
+        elif 'checksum' == message_type:
+            self._process_checksum_message(frame_number, data)
         elif 'tiles' == message_type:
             self._process_tiles_message(frame_number, data)
+        elif 'entities' == message_type:
+            self._process_entities_message(frame_number, data)
+        elif 'seq' == message_type:
+            self._process_seq_message(frame_number, data)
+        elif 'obs' == message_type:
+            self._process_obs_message(frame_number)
+        elif 'restored' == message_type:
+            self._process_restored_message(frame_number, data)
+        elif 'stats' == message_type:
+            self._process_stats_message(frame_number, data)
+        elif 'seedsaved' == message_type:
+            self._process_seedsaved_message()
         elif 'ready' == message_type:
             self._process_ready_message(frame_number)
         elif 'done' == message_type:
@@ -213,9 +389,165 @@ class SuperMarioBrosEnv(NesEnv):
         elif 'exit' == message_type:
             self._process_exit_message()
 
+    def step_sequence(self, actions, every=0):
+        # Runs a list of actions (ACTIONS_MAPPING indices) back to back, with a single message to the game
+        # Returns (observations, rewards, is_finished, infos), with one reward and one info per step
+        # - observations contains the observation every 'every' steps (if every > 0), and the last observation
+        # - the sequence stops at the first step where the episode is finished (the game also stops when Mario is
+        #   stuck, with the stuck tracking state sent with the actions, so the last observation is the one of that step)
+        if self._pending_steps:
+            raise gym.error.Error('step_sequence() cannot be called while steps are pending (call step_wait() first)')
+        if 0 == len(actions):
+            return [self._get_state()], np.zeros(0), self._get_is_finished(), []
+        if 0 == self.is_initialized or not self._wait_until_ready():
+            return [self._get_state()], np.zeros(0), True, []
+
+        start_frame = self.last_frame
+        self._send_noop_if_first_step(start_frame)
+        self._request_keyframe_if_needed(start_frame)
+        self.reward = 0
+        self.sequence_records = None
+        self.sequence_observations = []
+        self._write_to_pipe('sequence_%d#%d:%s:%s,%d,%d' % (start_frame, every, ','.join([str(int(a)) for a in actions]),
+                                                             self.stuck_duration, self.last_max_distance, self.last_max_distance_time))
+        self._wait_next_frame(start_frame)
+        if self.game_stuck:
+            return [self._get_state()], np.zeros(1), True, [dict(self._get_info(), ignore=True)]
+        if not self.sequence_records:
+            return [self._get_state()], np.zeros(0), True, []
+
+        # Rewards of all steps at once
+        records = np.array(self.sequence_records, dtype=np.int64)
+        infos = [dict(zip(SEQUENCE_FIELDS[:-1], record[:-1])) for record in self.sequence_records]
+        result = compute_rewards(
+            records[:, 0], records[:, 2], records[:, 1], records[:, 4],
+            old_distance=self.old_info.get('distance', DISTANCE_START),
+            old_score=self.old_info.get('score', 0),
+            old_life=self.old_info.get('life', 0),
+            last_max_distance=self.last_max_distance,
+            last_max_distance_time=self.last_max_distance_time,
+            reward_death=self.reward_death,
+            stuck_duration=self.stuck_duration,
+            shaping=self.reward_shaping,
+        )
+        is_done = result.is_dead | result.is_stuck | (records[:, -1] == 1)
+        num_steps = int(np.argmax(is_done)) + 1 if is_done.any() else len(records)
+        rewards = result.reward[:num_steps]
+        infos = infos[:num_steps]
+
+        # Updating the step state with the last step
+        self.dead = bool(result.is_dead[num_steps - 1])
+        self.stuck = bool(result.is_stuck[:num_steps].any())
+        self.last_max_distance = int(result.last_max_distance)
+        self.last_max_distance_time = int(result.last_max_distance_time)
+        self.reward = rewards[-1].item()
+        is_finished = self._get_is_finished() or bool(is_done[:num_steps].any())
+        observations = self.sequence_observations + [self._get_state()]
+        infos[-1].update(self._get_info())
+        self.old_info = copy.deepcopy(self.info)
+        return observations, rewards, is_finished, infos
+
+    def clone_state(self):
+        # Saves the game state in memory (in fceux) and returns a handle to pass to restore_state()
+        # The python side (info, reward variables and screen) is saved with it
+        if self._pending_steps:
+            raise gym.error.Error('clone_state() cannot be called while steps are pending (call step_wait() first)')
+        if 0 == self.is_initialized or self.is_finished or not self._wait_until_ready():
+            raise gym.error.Error('clone_state() can only be called while an episode is running')
+        self.last_state_handle += 1
+        handle = self.last_state_handle
+        self._write_to_pipe('clonestate_%d#%d' % (self.last_frame, handle))
+        self.saved_states[handle] = {
+            'info': copy.deepcopy(self.info),
+            'old_info': copy.deepcopy(self.old_info),
+            'reward': self.reward,
+            'episode_reward': self.episode_reward,
+            'last_max_distance': self.last_max_distance,
+            'last_max_distance_time': self.last_max_distance_time,
+            'dead': self.dead,
+            'stuck': self.stuck,
+            'first_step': self.first_step,
+            'curr_seed': self.curr_seed,
+            'screen': self.screen.copy(),
+            'palette_screen': self.palette_screen.copy(),
+            'tiles': self.tiles.copy() if self.tiles is not None else None,
+            'entities': self.entities.copy() if self.entities is not None else None,
+        }
+        return handle
+
+    def restore_state(self, handle):
+        # Restores a state saved with clone_state() (the state can be restored multiple times) - Returns the observation
+        # States are kept until free_state() is called or the game is closed
+        if handle not in self.saved_states:
+            raise gym.error.Error('Unknown state handle "{}"'.format(handle))
+        if self._pending_steps:
+            raise gym.error.Error('restore_state() cannot be called while steps are pending (call step_wait() first)')
+        if 0 == self.is_initialized:
+            raise gym.error.Error('restore_state() cannot be called after the game is closed')
+
+        # Waiting for the game to confirm (the frame number is not known in advance)
+        self.restored_frame = None
+        self._write_to_pipe('restorestate_%d#%d' % (self.last_frame, handle))
+        loop_counter = 0
+        while self.restored_frame is None:
+            loop_counter += 1
+            sleep(0.001)
+            if 0 == self.is_initialized or loop_counter >= 50000:
+                raise gym.error.Error('The game did not respond while restoring the state "{}"'.format(handle))
+        if str(handle) != self.restored_handle:
+            raise gym.error.Error('The game could not restore the state "{}"'.format(handle))
+
+        saved = self.saved_states[handle]
+        self.last_frame = self.restored_frame
+        self.is_finished = False
+        self.info = copy.deepcopy(saved['info'])
+        self.old_info = copy.deepcopy(saved['old_info'])
+        self.reward = saved['reward']
+        self.episode_reward = saved['episode_reward']
+        self.last_max_distance = saved['last_max_distance']
+        self.last_max_distance_time = saved['last_max_distance_time']
+        self.dead = saved['dead']
+        self.stuck = saved['stuck']
+        self.first_step = saved['first_step']
+        self.curr_seed = saved['curr_seed']
+        self.screen[:] = saved['screen']
+        self.palette_screen[:] = saved['palette_screen']
+        if saved['tiles'] is not None:
+            self.tiles[:] = saved['tiles']
+        if saved['entities'] is not None:
+            self.entities[:] = saved['entities']
+        self.keyframe_needed = False    # The game restores the screen it last sent with the state, and only sends diffs
+        self._frame_results.clear()
+        return self._get_state()
+
+    def free_state(self, handle):
+        # Frees a state saved with clone_state()
+        if self.saved_states.pop(handle, None) is not None:
+            self._write_to_pipe('freestate#%d' % handle)
+
+    def _make_standby(self):
+        # Spare env launching the same level with the same options (see StandbyPool)
+        env = SuperMarioBrosEnv(draw_tiles=self.draw_tiles, level=self.level, obs_mode=self.obs_mode)
+        env.launch_vars.update(self.launch_vars)
+        env.cmd_args = list(self.cmd_args)
+        env.rom_path = self.rom_path
+        env.cpus = self.cpus
+        env.nice = self.nice
+        env.seed_cache_home = self.seed_cache_home
+        return env
+
+    def close(self):
+        # States saved in memory are lost when fceux is closed
+        self.saved_states.clear()
+        NesEnv.close(self)
+        if self.entities is not None:
+            self._clear_entities()
+
     def _get_state(self):
         if 1 == self.draw_tiles:
             return self.tiles.copy()
+        elif self.entities is not None:
+            return self.entities.copy()
         else:
             return self.screen.copy()
 
@@ -234,12 +566,10 @@ class MetaSuperMarioBrosEnv(SuperMarioBrosEnv, MetaNesEnv):
     def _process_reset_message(self):
         self.last_frame = 0
 
+    def _make_standby(self):
+        # Not supported - The meta env changes level in the same game
+        return None
+
     def _get_standard_reward(self, episode_reward):
         # Returns a standardized reward for an episode (i.e. between 0 and 1,000)
-        min_score = 0
-        target_score = float(SMB_LEVELS[self.level][MAX_DISTANCE]) - 40
-        max_score = min_score + (target_score - min_score) / 0.99  # Target is 99th percentile (Scale 0-1000)
-        std_reward = round(1000 * (episode_reward - min_score) / (max_score - min_score), 4)
-        std_reward = min(1000, std_reward)  # Cannot be more than 1,000
-        std_reward = max(0, std_reward)  # Cannot be less than 0
-        return std_reward
+        return get_standard_reward(self.level, episode_reward)
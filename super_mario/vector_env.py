@@ -0,0 +1,287 @@
+import logging
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+import numpy as np
+
+import gym
+
+from .placement import allocate_cpus, parse_cpus, set_affinity
+from .spectator import SpectatorTap, DEFAULT_ADDRESS, DEFAULT_FPS, DEFAULT_DOWNSAMPLE
+
+logger = logging.getLogger(__name__)
+
+# Vector env running the envs in worker processes (each worker owns a few envs, their listening threads and
+# the decoding of their messages). Observations, rewards, dones and info records are written in shared memory
+# slabs, and the learner process only copies the slabs (no per-pixel work and no message parsing)
+#
+# Every step: the learner writes the actions, releases the start semaphore of every worker, and waits for
+# every worker to release the done semaphore
+
+# Info fields stored in the info slab (int32, -1 if unknown)
+# ignore is 1 when the game stopped responding and was terminated (NesEnv.step_wait sets info['ignore'])
+INFO_FIELDS = ['distance', 'life', 'score', 'coins', 'time', 'player_status', 'ignore', 'truncated']
+
+COMMAND_RESET = 1
+COMMAND_STEP = 2
+COMMAND_CLOSE = 3
+
+
+class SharedSlabs(object):
+    # Shared memory arrays of a vector env (created by the learner, and mapped with np.frombuffer in the workers)
+
+    def __init__(self, num_envs, obs_shape, obs_dtype):
+        self.num_envs = num_envs
+        self.obs_shape = tuple(obs_shape)
+        self.obs_dtype = np.dtype(obs_dtype)
+        obs_size = num_envs * int(np.prod(self.obs_shape)) * self.obs_dtype.itemsize
+        self.buffers = {
+            'observations': RawArray('B', obs_size),
+            'terminal_observations': RawArray('B', obs_size),
+            'rewards': RawArray('d', num_envs),
+            'dones': RawArray('B', num_envs),
+            'infos': RawArray('i', num_envs * len(INFO_FIELDS)),
+            'actions': RawArray('i', num_envs),
+        }
+        self._map()
+
+    def _map(self):
+        shape = (self.num_envs,) + self.obs_shape
+        self.observations = np.frombuffer(self.buffers['observations'], dtype=self.obs_dtype).reshape(shape)
+        self.terminal_observations = np.frombuffer(self.buffers['terminal_observations'], dtype=self.obs_dtype).reshape(shape)
+        self.rewards = np.frombuffer(self.buffers['rewards'], dtype=np.float64)
+        self.dones = np.frombuffer(self.buffers['dones'], dtype=np.uint8)
+        self.infos = np.frombuffer(self.buffers['infos'], dtype=np.int32).reshape((self.num_envs, len(INFO_FIELDS)))
+        self.actions = np.frombuffer(self.buffers['actions'], dtype=np.int32)
+
+    def __getstate__(self):
+        # Only the shared buffers are sent to the workers (the arrays are mapped again)
+        return {'num_envs': self.num_envs, 'obs_shape': self.obs_shape, 'obs_dtype': self.obs_dtype, 'buffers': self.buffers}
+
+    def __setstate__(self, state):
+        self.num_envs = state['num_envs']
+        self.obs_shape = state['obs_shape']
+        self.obs_dtype = np.dtype(state['obs_dtype'])
+        self.buffers = state['buffers']
+        self._map()
+
+
+def _write_info(slabs, index, info, truncated=False):
+    record = slabs.infos[index]
+    for i, name in enumerate(INFO_FIELDS[:-2]):
+        record[i] = info.get(name, -1)
+    record[-2] = 1 if info.get('ignore') else 0
+    record[-1] = 1 if truncated else 0
+
+
+def _worker(env_ids, env_indices, slabs, start_semaphore, done_semaphore, command, error, configure, cpus, lock):
+    # Worker process - Owns the envs env_indices, and runs the commands sent by the learner
+    # The done semaphore is released once the envs are created, then after every command (error is set on failure)
+    set_affinity(0, cpus)
+    envs = []
+    max_steps = []
+    try:
+        for env_id in env_ids:
+            env = gym.make(env_id)
+            max_steps.append(getattr(env.spec, 'max_episode_steps', None))
+            env = env.unwrapped
+            if lock is not None and hasattr(env, 'lock'):
+                env.lock = lock
+            options = dict(configure or {})
+            if cpus:
+                options['cpu_affinity'] = cpus
+            env.configure(**options)
+            envs.append(env)
+    except Exception as e:
+        logger.error('Unable to create the envs of a vector env worker (envs %s): %s' % (env_indices, e))
+        error.value = 1
+    step_counts = [0] * len(envs)
+    done_semaphore.release()
+
+    while True:
+        start_semaphore.acquire()
+        if COMMAND_CLOSE == command.value:
+            for env in envs:
+                env.close()
+            done_semaphore.release()
+            return
+        if len(envs) < len(env_ids):
+            # Envs could not be created
+            error.value = 1
+            done_semaphore.release()
+            continue
+        try:
+            if COMMAND_RESET == command.value:
+                for i, env in enumerate(envs):
+                    slabs.observations[env_indices[i]] = env.reset()
+                    step_counts[i] = 0
+            elif COMMAND_STEP == command.value:
+                # Sending all the actions first, so the games of this worker emulate in parallel
+                for i, env in enumerate(envs):
+                    env.step_async(int(slabs.actions[env_indices[i]]))
+                for i, env in enumerate(envs):
+                    index = env_indices[i]
+                    observation, reward, is_finished, info = env.step_wait()
+                    step_counts[i] += 1
+                    truncated = not is_finished and max_steps[i] is not None and step_counts[i] >= max_steps[i]
+                    slabs.rewards[index] = reward
+                    slabs.dones[index] = 1 if (is_finished or truncated) else 0
+                    _write_info(slabs, index, info, truncated)
+                    if is_finished or truncated:
+                        # Resetting automatically, the last observation is kept in terminal_observations
+                        slabs.terminal_observations[index] = observation
+                        observation = env.reset()
+                        step_counts[i] = 0
+                    slabs.observations[index] = observation
+        except Exception as e:
+            logger.error('Error in vector env worker (envs %s): %s' % (env_indices, e))
+            error.value = 1
+        done_semaphore.release()
+
+
+class ProcessVectorEnv(object):
+    # Vector env with num_envs envs, run by worker processes owning envs_per_worker envs each
+    # Envs that are done are reset automatically, their last observation is in info['terminal_observation']
+    #
+    # env_id can be a gym env id or a list of num_envs ids (e.g. one level per env)
+    # cpu_affinity: None, 'auto' (next core for every worker) or a list of cores per worker
+    # configure: kwargs passed to env.configure() in the workers
+
+    def __init__(self, env_id, num_envs=None, envs_per_worker=1, configure=None, cpu_affinity=None, context=None):
+        env_ids = list(env_id) if isinstance(env_id, (list, tuple)) else [env_id] * (num_envs or 1)
+        self.num_envs = len(env_ids)
+        self.closed = False
+
+        # Spaces (the env is not launched)
+        probe = gym.make(env_ids[0])
+        self.observation_space = probe.observation_space
+        self.action_space = probe.action_space
+        probe.close()
+        self.slabs = SharedSlabs(self.num_envs, self.observation_space.shape, getattr(self.observation_space, 'dtype', np.uint8))
+
+        # The fceux launch lock is passed to the workers (a forked worker would inherit the NesLock singleton,
+        # but a spawned worker would create its own), so the games of all workers are launched one at a time
+        # The NesLock lock is created with the default start method, other start methods need their own lock
+        from .nes_env import NesLock
+        ctx = multiprocessing.get_context(context)
+        if ctx.get_start_method() == multiprocessing.get_start_method():
+            lock = NesLock().get_lock()
+        else:
+            lock = ctx.Lock()
+        self.done_semaphore = ctx.Semaphore(0)
+        self.workers = []
+        for first in range(0, self.num_envs, envs_per_worker):
+            env_indices = list(range(first, min(first + envs_per_worker, self.num_envs)))
+            if 'auto' == cpu_affinity:
+                cpus = allocate_cpus()
+            elif isinstance(cpu_affinity, (list, tuple)) and cpu_affinity and isinstance(cpu_affinity[0], (list, tuple, str)):
+                cpus = parse_cpus(cpu_affinity[len(self.workers) % len(cpu_affinity)])
+            else:
+                cpus = parse_cpus(cpu_affinity)
+            worker = {
+                'start_semaphore': ctx.Semaphore(0),
+                'command': RawValue('i', 0),
+                'error': RawValue('i', 0),
+                'env_indices': env_indices,
+            }
+            worker['process'] = ctx.Process(
+                target=_worker,
+                args=([env_ids[i] for i in env_indices], env_indices, self.slabs, worker['start_semaphore'],
+                      self.done_semaphore, worker['command'], worker['error'], configure, cpus, lock))
+            worker['process'].daemon = True
+            worker['process'].start()
+            self.workers.append(worker)
+        self.waiting = False
+        self.step_count = 0         # Number of resets and steps (frame number of the spectator taps)
+        self.spectators = {}        # SpectatorTap by env index (see attach_spectator)
+
+        # Waiting for the workers to create their envs
+        try:
+            self._wait()
+        except gym.error.Error:
+            self.close()
+            raise
+
+    def _send(self, command):
+        for worker in self.workers:
+            worker['command'].value = command
+            worker['start_semaphore'].release()
+
+    def _wait(self):
+        for _ in self.workers:
+            self.done_semaphore.acquire()
+        failed = [worker['env_indices'] for worker in self.workers if worker['error'].value]
+        if failed:
+            for worker in self.workers:
+                worker['error'].value = 0
+            raise gym.error.Error('Error in vector env workers (envs %s), see the worker logs' % failed)
+
+    def reset(self):
+        self._send(COMMAND_RESET)
+        self._wait()
+        self.step_count += 1
+        return self.slabs.observations.copy()
+
+    def step_async(self, actions):
+        self.slabs.actions[:] = actions
+        self._send(COMMAND_STEP)
+        self.waiting = True
+
+    def step_wait(self):
+        # Returns (observations, rewards, dones, infos)
+        self._wait()
+        self.waiting = False
+        self.step_count += 1
+        slabs = self.slabs
+        dones = slabs.dones.astype(bool)
+        infos = []
+        for index in range(self.num_envs):
+            info = dict(zip(INFO_FIELDS[:-2], slabs.infos[index, :-2].tolist()))
+            if slabs.infos[index, -2]:
+                info['ignore'] = True
+            if slabs.infos[index, -1]:
+                info['TimeLimit.truncated'] = True
+            if dones[index]:
+                info['terminal_observation'] = slabs.terminal_observations[index].copy()
+            infos.append(info)
+        return slabs.observations.copy(), slabs.rewards.copy(), dones, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def get_info_array(self):
+        # Returns the info records of the last step as an int32 array (num_envs, len(INFO_FIELDS))
+        return self.slabs.infos.copy()
+
+    def attach_spectator(self, index, address=DEFAULT_ADDRESS, fps=DEFAULT_FPS, downsample=DEFAULT_DOWNSAMPLE):
+        # Publishes the observations of env 'index' to a viewer (see spectator.py)
+        # The tap reads the shared observation slab from a background thread, the workers are not involved
+        self.detach_spectator(index)
+        observations = self.slabs.observations
+        self.spectators[index] = SpectatorTap(
+            lambda: (self.step_count, observations[index]) if self.step_count > 0 else None,
+            address=address, fps=fps, downsample=downsample)
+        return self.spectators[index]
+
+    def detach_spectator(self, index):
+        spectator = self.spectators.pop(index, None)
+        if spectator is not None:
+            spectator.close()
+
+    def close(self):
+        if self.closed:
+            return
+        for index in list(self.spectators):
+            self.detach_spectator(index)
+        if self.waiting:
+            try:
+                self._wait()
+            except gym.error.Error:
+                pass
+        self._send(COMMAND_CLOSE)
+        for worker in self.workers:
+            worker['process'].join(timeout=30)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+        self.closed = True
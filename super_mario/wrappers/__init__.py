@@ -1,2 +1,3 @@
 from .action_space import *
 from .control import *
+from .frame_stack import *
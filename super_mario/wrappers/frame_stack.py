@@ -0,0 +1,175 @@
+import weakref
+from collections import deque
+
+import numpy as np
+
+import gym
+
+__all__ = [ 'FrameStack', 'BatchFrameStack', 'FrameRing', 'LazyFrames' ]
+
+FRAME_MODES = ['grayscale', 'palette']
+GRAYSCALE_WEIGHTS = np.array([0.299, 0.587, 0.114])
+
+
+def to_frame(observation, frame_mode='grayscale', env=None):
+    # Converts an observation to a single channel uint8 frame
+    # 'grayscale' - Luminance of the RGB screen (tiles are returned as-is)
+    # 'palette' - NES palette index of each pixel, as sent by the game (requires the env)
+    if 'palette' == frame_mode:
+        return env.unwrapped.palette_screen
+    observation = np.asarray(observation)
+    if observation.ndim >= 3 and 3 == observation.shape[-1]:
+        return np.dot(observation, GRAYSCALE_WEIGHTS).astype(np.uint8)
+    return observation.astype(np.uint8, copy=False)
+
+
+class FrameRing(object):
+    """
+        Preallocated ring buffer of frames
+
+        Frames are pushed once per step. stacked() returns a LazyFrames view of the last num_stack frames,
+        which is only materialized when consumed (or when the ring is about to overwrite one of its frames).
+        Frames before the start of the episode are replaced by its first frame.
+
+        frame_shape can include a leading batch dimension (num_envs, ...) when envs are stepped together
+    """
+    def __init__(self, num_stack, frame_shape, dtype=np.uint8, capacity=None, num_envs=None):
+        self.num_stack = num_stack
+        self.capacity = max(capacity or 2 * num_stack, num_stack)
+        self.num_envs = num_envs
+        self.frames = np.zeros((self.capacity,) + tuple(frame_shape), dtype=dtype)
+        self.count = 0                                          # Number of frames pushed
+        self.starts = 0 if num_envs is None else np.zeros(num_envs, dtype=np.int64)    # First frame of episodes
+        self.views = deque()                                    # Weak references to views, oldest first
+
+    def push(self, frame):
+        # Views referencing the frame about to be overwritten are materialized first
+        evicted = self.count - self.capacity
+        while self.views:
+            view = self.views[0]()
+            if view is not None and not view.is_materialized:
+                if view.first > evicted:
+                    break
+                view.materialize()
+            self.views.popleft()
+        self.frames[self.count % self.capacity] = frame
+        self.count += 1
+
+    def start_episode(self, env_indices=None):
+        # Marks the last pushed frame as the first frame of an episode (for all envs, or only env_indices)
+        if self.num_envs is None:
+            self.starts = self.count - 1
+        elif env_indices is None:
+            self.starts[:] = self.count - 1
+        else:
+            self.starts[env_indices] = self.count - 1
+
+    def stacked(self):
+        view = LazyFrames(self, self.count - 1, self.starts)
+        self.views.append(weakref.ref(view))
+        return view
+
+
+class LazyFrames(object):
+    """
+        Stack of the last num_stack frames of a FrameRing, with shape frame_shape + (num_stack,)
+
+        The frames are only copied out of the ring when the view is consumed (e.g. np.asarray(view))
+    """
+    __slots__ = ('ring', 'first', 'last', 'starts', '_array', '__weakref__')
+
+    def __init__(self, ring, last, starts):
+        self.ring = ring
+        self.last = last
+        self.first = last - ring.num_stack + 1
+        self.starts = starts.copy() if isinstance(starts, np.ndarray) else starts
+        self._array = None
+
+    @property
+    def is_materialized(self):
+        return self._array is not None
+
+    def materialize(self):
+        if self._array is None:
+            ring = self.ring
+            frame_shape = ring.frames.shape[1:]
+            array = np.empty(frame_shape + (ring.num_stack,), dtype=ring.frames.dtype)
+            for j, index in enumerate(range(self.first, self.last + 1)):
+                if ring.num_envs is None:
+                    array[..., j] = ring.frames[max(index, self.starts) % ring.capacity]
+                else:
+                    indices = np.maximum(index, self.starts) % ring.capacity
+                    array[..., j] = ring.frames[indices, np.arange(ring.num_envs)]
+            self._array = array
+            self.ring = None
+        return self._array
+
+    def __array__(self, dtype=None):
+        array = self.materialize()
+        return array if dtype is None else array.astype(dtype)
+
+    @property
+    def shape(self):
+        if self._array is not None:
+            return self._array.shape
+        return self.ring.frames.shape[1:] + (self.ring.num_stack,)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        return self.materialize()[item]
+
+
+def FrameStack(num_stack=4, frame_mode='grayscale', capacity=None):
+    """ frame_mode can be 'grayscale' or 'palette' """
+
+    class FrameStackWrapper(gym.Wrapper):
+        """
+            Wrapper to stack the last num_stack frames (as single channel uint8 frames)
+
+            Returns LazyFrames observations of shape (height, width, num_stack), backed by a ring buffer
+        """
+        def __init__(self, env):
+            super(FrameStackWrapper, self).__init__(env)
+            if frame_mode not in FRAME_MODES:
+                raise gym.error.Error('Error - The frame mode "{}" is not supported. Supported options are "grayscale" or "palette"'.format(frame_mode))
+            frame_shape = tuple(env.observation_space.shape[:2])
+            self.ring = FrameRing(num_stack, frame_shape, capacity=capacity)
+            self.observation_space = gym.spaces.Box(low=0, high=255, shape=frame_shape + (num_stack,), dtype=np.uint8)
+
+        def reset(self, **kwargs):
+            observation = self.env.reset(**kwargs)
+            self.ring.push(to_frame(observation, frame_mode, self.env))
+            self.ring.start_episode()
+            return self.ring.stacked()
+
+        def step(self, action):
+            observation, reward, is_finished, info = self.env.step(action)
+            self.ring.push(to_frame(observation, frame_mode, self.env))
+            return self.ring.stacked(), reward, is_finished, info
+
+    return FrameStackWrapper
+
+
+class BatchFrameStack(object):
+    """
+        Frame stacker for a batch of envs stepped together (e.g. RemoteVectorEnv)
+
+        Takes batches of observations (num_envs, height, width, 3) and returns LazyFrames of
+        shape (num_envs, height, width, num_stack). Envs that are done are expected to be reset
+        automatically (i.e. their observation is the first observation of the next episode)
+    """
+    def __init__(self, num_envs, frame_shape, num_stack=4, capacity=None):
+        self.ring = FrameRing(num_stack, (num_envs,) + tuple(frame_shape[:2]), capacity=capacity, num_envs=num_envs)
+
+    def reset(self, observations):
+        self.ring.push(to_frame(observations))
+        self.ring.start_episode()
+        return self.ring.stacked()
+
+    def step(self, observations, dones):
+        self.ring.push(to_frame(observations))
+        if np.any(dones):
+            self.ring.start_episode(np.flatnonzero(dones))
+        return self.ring.stacked()